@@ -9,14 +9,19 @@ import os.path
 import sys
 #TODO: refactor to use hgsc_vcf library
 import hgsc_vcf
+from hgsc_vcf.index import IntervalIndex
+from hgsc_vcf.fasta import FastaFile, FastaWindow
+import cosmic_db
 import re
 import logging
-import htsjdk.samtools.reference.IndexedFastaSequenceFile as IndexedFastaSequenceFile
-import org.bcm.hgsc.utils.SynchronousIndexedFastaReader as SFastaReader
-import java.io.File as File
-import java.lang.String as String
-from java.lang import Class
-from java.sql  import DriverManager, SQLException
+from collections import OrderedDict
+# CPython uses the sqlite3 module, under Jython the sqlite JDBC driver is used
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+    from java.lang import Class
+    from java.sql  import DriverManager, SQLException
 
 JDBC_DRIVER = "org.sqlite.JDBC"
 
@@ -158,7 +163,8 @@ def get_codon_genomic_range(position_i, codon_s, pos_strand_b=True):
 ##
 # Conatiner for VCF files
 #
-# allows rapid searching and manipulation of VCF files in memory
+# allows rapid searching and manipulation of VCF files in memory, each
+# contig gets an IntervalIndex over [POS, POS + len(REF)] of its records
 class VCFContainer:
 
     def __init__(self, reader, buffer):
@@ -166,8 +172,6 @@ class VCFContainer:
         self.buffer = buffer
         self.records = {}
         self.__load()
-        self.lastindex = 0
-        self.lastpos = 0
 
     def __load(self):
         logger.info("Reading VCF file into memory")
@@ -175,32 +179,19 @@ class VCFContainer:
             if record['CHROM'] not in self.records:
                 self.records[record['CHROM']] = []
             self.records[record['CHROM']].append(record)
+        self.indexes = {}
+        for _chrom, _records in self.records.items():
+            self.indexes[_chrom] = IntervalIndex(
+                    [(_r['POS'], _r['POS'] + len(_r['REF']), _r) for _r in _records])
 
     ##
     # return a list of records within the indicated buffer limit
     def intersect(self, record):
-        if not record['CHROM'] in self.records:
+        if not record['CHROM'] in self.indexes:
             return []
-        _record_set = self.records[record['CHROM']]
         _pos = record['POS'] - self.buffer
         _end = record['POS'] + len(record['REF']) + self.buffer
-
-        if _pos > self.lastpos:
-            self.lastindex = 0
-        self.lastpos = _pos
-
-        _result = []
-        for _i in range(self.lastindex, len(_record_set)):
-            _test_record = _record_set[_i]
-            if ((_test_record['POS'] + len(_test_record['REF']))
-                    >= _pos) and (_test_record['POS'] <= _end):
-                _result.append(_test_record)
-            elif _test_record['POS'] > _end:
-                break  # exceeded the end, stop
-            self.lastpos = _test_record['POS']
-            self.lastindex = _i
-
-        return _result
+        return self.indexes[record['CHROM']].overlapping(_pos, _end)
 
 MATCH_PRIORITY = {'SITE': 0, 'CODON': 1, 'BUFFER': 2, 'NONE':3}
 ##
@@ -256,40 +247,154 @@ def add_info_to_reader(reader, header):
 def add_command_to_reader(reader, command):
     reader.header.add_header(command)
 
-def get_val_status(rsid, con):
-    resultSet = con.executeQuery("select rsid, valstatus from dbsnpvalstat where rsid = \"%s\"" % rsid)
-    while resultSet.next():
-        yield resultSet.getString("valstatus")
+VALSTATUS_BATCH = 500 # stays below the sqlite limit of 999 query parameters
+VALSTATUS_CACHE = 100000
+RECORD_CHUNK = 1000
 
-def generate_valstatus_info(_existing_ids, _valdata):
-    dbCon = getConnection("jdbc:sqlite:%s"  % _valdata, JDBC_DRIVER)
-    con = dbCon.createStatement()
-    try:
-        _vals = [v for _id in _existing_ids for v in get_val_status(_id, con)]
-        _vals_set = set(_vals)
-        if len(_vals_set) > 0:
-            return "|".join(_vals_set)
+##
+# dbSNP validation status lookup
+#
+# keeps a single connection to the valstatus database open for the whole
+# run, through sqlite3 or the sqlite JDBC driver under Jython.  rsids are
+# looked up in batches with parameterized IN (...) queries and the
+# statuses of the most recently used rsids are kept in an LRU cache, rsids
+# without a status are cached as well.
+class ValStatusLookup(object):
+
+    def __init__(self, valdata, cache_size = VALSTATUS_CACHE, batch_size = VALSTATUS_BATCH):
+        if not os.path.isfile(valdata):
+            raise IOError("dbSNP validation database %s does not exist" % valdata)
+        if sqlite3 is not None:
+            self.con = sqlite3.connect(valdata)
+            self.con.text_factory = str
         else:
-            return '.'
-    finally:
-        con.close()
-        dbCon.close()
+            self.con = getConnection("jdbc:sqlite:%s" % valdata, JDBC_DRIVER)
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.cache = OrderedDict()
 
-def main(args):
-    vcf_reader = hgsc_vcf.Reader(args.INPUTVCF)
-    vcf_container_cosmic = VCFContainer(
-        hgsc_vcf.Reader(
-            args.COSMICVCF),
-        args.buffer)
+    def close(self):
+        self.con.close()
+
+    ##
+    # returns {rsid: [valstatus, ...]} for the rsids found in the database
+    def _query(self, rsids):
+        query = "select rsid, valstatus from dbsnpvalstat where rsid in (%s)" % ','.join(['?'] * len(rsids))
+        if sqlite3 is not None:
+            result = {}
+            for rsid, valstatus in self.con.execute(query, rsids):
+                result.setdefault(str(rsid), []).append(valstatus)
+            return result
+        stmt = self.con.prepareStatement(query)
+        try:
+            for i, rsid in enumerate(rsids):
+                stmt.setString(i + 1, rsid)
+            resultSet = stmt.executeQuery()
+            result = {}
+            while resultSet.next():
+                result.setdefault(resultSet.getString("rsid"), []).append(resultSet.getString("valstatus"))
+            return result
+        finally:
+            stmt.close()
+
+    def _remember(self, rsid, vals):
+        self.cache[rsid] = vals
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    ##
+    # looks up all of the rsids that are not cached yet
+    def prefetch(self, rsids):
+        _missing = []
+        _seen = set()
+        for rsid in rsids:
+            if rsid and rsid not in self.cache and rsid not in _seen:
+                _seen.add(rsid)
+                _missing.append(rsid)
+        for i in range(0, len(_missing), self.batch_size):
+            _batch = _missing[i:i + self.batch_size]
+            _found = self._query(_batch)
+            for rsid in _batch:
+                self._remember(rsid, tuple(_found.get(rsid, ())))
+
+    ##
+    # the validation statuses of rsid
+    def get(self, rsid):
+        if not rsid:
+            return ()
+        try:
+            vals = self.cache.pop(rsid)
+        except KeyError:
+            self.prefetch([rsid])
+            return self.cache[rsid]
+        self.cache[rsid] = vals # most recently used
+        return vals
+
+def get_csq_list(record, vep_format):
+    return [dict(zip(vep_format, _csq.split('|')))
+            for _csq in record['INFO'].get('CSQ')]
+
+def get_existing_ids(csq_l):
+    return [_id for _csq in csq_l for _id in _csq['Existing_variation'].split('&')]
+
+##
+# looks up the rsids of a chunk of records in one go
+def prefetch_valstatus(records, vep_format, valstatus):
+    _ids = []
+    for record in records:
+        if 'CSQ' in record['INFO']:
+            try:
+                _ids.extend(get_existing_ids(get_csq_list(record, vep_format)))
+            except:
+                pass # reported when the record is annotated
+    valstatus.prefetch(_ids)
+
+def generate_valstatus_info(_existing_ids, valstatus):
+    _vals_set = set([v for _id in _existing_ids for v in valstatus.get(_id)])
+    if len(_vals_set) > 0:
+        return "|".join(_vals_set)
+    else:
+        return '.'
+
+def chunks(iterable, size):
+    _chunk = []
+    for item in iterable:
+        _chunk.append(item)
+        if len(_chunk) >= size:
+            yield _chunk
+            _chunk = []
+    if _chunk:
+        yield _chunk
+
+##
+# annotates the vcf in input_fobj with COSMIC, CONTEXT and DBVS and writes it to output_fobj
+#
+# this is what main runs, merge.py calls it directly to annotate in process.
+# cosmic is a COSMIC vcf or a database compiled from it with cosmic_db.py,
+# valdata the dbSNP validation status database and reference a FASTA file
+# with a .fai index.
+def annotate_vcf(input_fobj, output_fobj, cosmic, valdata, reference, buffer = 10, command = None):
+    vcf_reader = hgsc_vcf.Reader(input_fobj)
+    # a database compiled with cosmic_db.py is mapped, a VCF is read into memory
+    if cosmic_db.is_cosmic_db(cosmic):
+        vcf_container_cosmic = cosmic_db.CosmicDB(cosmic, buffer)
+        cosmic_source = vcf_container_cosmic.source
+    else:
+        vcf_container_cosmic = VCFContainer(
+            hgsc_vcf.Reader(
+                hgsc_vcf.open_vcf(cosmic), compact = True),
+            buffer)
+        cosmic_source = cosmic
     # read in the dbsnp data
-    # connect to the reference file
-    ifasta = IndexedFastaSequenceFile(File(args.reference))
-    add_command_to_reader(vcf_reader, '##COMMAND=<ID=annotate_vcf_cosmic.py,Params="%s">' % " ".join(sys.argv))
+    # connect to the reference file, the input is sorted so context is read a window at a time
+    ifasta = FastaWindow(FastaFile(reference))
+    if command is not None:
+        add_command_to_reader(vcf_reader, '##COMMAND=<ID=annotate_vcf_cosmic.py,Params="%s">' % command)
     # add the COSMIC header info
     add_info_to_reader(vcf_reader, '##INFO=<ID=COSMIC,Number=.,Type=String,Description="' + 
         'COSMIC info, can be one of NONE, BUFFER, CODON, SITE.  ' +
         'All but NONE are accompanied by AA|CDS|CNT BUFFER indicates the COSMIC site is within %(buffer)sbp of the position.  example: ' +
-        'SITE|p.P228fs*227|c.682_683insT|3 or NONE.  VCF file used was %(cosmicvcf)s.">\n' % {'buffer': str(args.buffer), 'cosmicvcf': args.COSMICVCF})
+        'SITE|p.P228fs*227|c.682_683insT|3 or NONE.  VCF file used was %(cosmicvcf)s.">\n' % {'buffer': str(buffer), 'cosmicvcf': cosmic_source})
 
     # add the context
     add_info_to_reader(vcf_reader, "##INFO=<ID=CONTEXT,Number=1,Type=String,Description=\"Base context around variant. [POS - 5, POS + len(REF) + 4]\">\n")
@@ -298,30 +403,39 @@ def main(args):
     # get the format for the vep annotations
     _vep_format = get_csq_format([h for h in vcf_reader.header.get_headers('INFO', 'CSQ')][0].fields['Description'])
 
-    vcf_writer = hgsc_vcf.Writer(args.OUTPUTVCF, vcf_reader.header)
+    vcf_writer = hgsc_vcf.Writer(output_fobj, vcf_reader.header, buffer_size = hgsc_vcf.WRITE_BUFFER)
     vcf_writer.write_header()
-    for record in vcf_reader:
-        try:
-            ## check that the position is annotated with CSQ, if not then this is a write through
-            if 'CSQ' in record['INFO']:
-                # matches are intersecting hits in the VCF
-                
-                _matches = vcf_container_cosmic.intersect(record)
-                _csq_l = [dict(zip(_vep_format, _csq.split('|')))
-                          for _csq in record['INFO'].get('CSQ')]
-                _info = generate_cosmic_info(_matches, _csq_l, record)
-                record['INFO']['COSMIC'] = _info
-                # extract the dbsnp validation rsids
-                _existing_ids = [_id for _csq in _csq_l for _id in _csq['Existing_variation'].split('&')]
-                record['INFO']['DBVS'] = [generate_valstatus_info(_existing_ids, args.DBSNPVAL)]
-            record['INFO']['CONTEXT'] = [str(
-                    String(
-                        ifasta.getSubsequenceAt(record['CHROM'], record['POS'] - 5, record['POS'] + len(record['REF']) + 4).getBases()
-                        ))]
-            
-        except:
-            logger.exception("Error in record modification")
-        vcf_writer.write_record(record)
+    valstatus = ValStatusLookup(valdata)
+    try:
+        for _chunk in chunks(vcf_reader, RECORD_CHUNK):
+            prefetch_valstatus(_chunk, _vep_format, valstatus)
+            for record in _chunk:
+                try:
+                    ## check that the position is annotated with CSQ, if not then this is a write through
+                    if 'CSQ' in record['INFO']:
+                        # matches are intersecting hits in the VCF
+
+                        _matches = vcf_container_cosmic.intersect(record)
+                        _csq_l = get_csq_list(record, _vep_format)
+                        _info = generate_cosmic_info(_matches, _csq_l, record)
+                        record['INFO']['COSMIC'] = _info
+                        # extract the dbsnp validation rsids
+                        _existing_ids = get_existing_ids(_csq_l)
+                        record['INFO']['DBVS'] = [generate_valstatus_info(_existing_ids, valstatus)]
+                    record['INFO']['CONTEXT'] = [
+                            ifasta.fetch(record['CHROM'], record['POS'] - 5, record['POS'] + len(record['REF']) + 4)]
+
+                except:
+                    logger.exception("Error in record modification")
+                vcf_writer.write_record(record)
+    finally:
+        valstatus.close()
+        ifasta.close()
+    vcf_writer.flush()
+
+def main(args):
+    annotate_vcf(args.INPUTVCF, args.OUTPUTVCF, args.COSMICVCF, args.DBSNPVAL, args.reference,
+            args.buffer, " ".join(sys.argv))
 
 
 ##
@@ -331,6 +445,47 @@ def main(args):
 def get_csq_hgvsp_aa_number(csq_hgvsp_s):
     pass
 
+def test():
+    import tempfile, shutil
+    print "starting test"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        valdata = os.path.join(tmpdir, 'valstatus.db')
+        con = sqlite3.connect(valdata)
+        con.execute("create table dbsnpvalstat (rsid text, valstatus text)")
+        rows = [('rs%d' % i, v) for i in xrange(1, 20) for v in ('by-cluster', 'by-1000G')[:i % 3]]
+        con.executemany("insert into dbsnpvalstat values (?, ?)", rows)
+        con.commit()
+        con.close()
+        expected = {}
+        for rsid, v in rows:
+            expected.setdefault(rsid, []).append(v)
+
+        lookup = ValStatusLookup(valdata, cache_size = 5, batch_size = 3)
+        queries = []
+        query = lookup._query
+        def counted(rsids):
+            queries.append(list(rsids))
+            return query(rsids)
+        lookup._query = counted
+        # repeated and empty rsids are left out, the rest go in batches
+        rsids = ['rs%d' % i for i in xrange(1, 8)]
+        lookup.prefetch(rsids + ['rs1', '', None])
+        assert queries == [rsids[0:3], rsids[3:6], rsids[6:7]], queries
+        # only the 5 most recently used are kept, the others are looked up again
+        assert lookup.cache.keys() == rsids[2:]
+        del queries[:]
+        for rsid in ['rs5', 'rs3', 'rs1', 'rs3', 'rs99', 'rs99', 'rs2', '']:
+            assert lookup.get(rsid) == tuple(expected.get(rsid, ())), rsid
+        assert queries == [['rs1'], ['rs99'], ['rs2']], queries
+        assert lookup.cache.keys() == ['rs5', 'rs1', 'rs3', 'rs99', 'rs2']
+        # rsids without a status are cached too
+        assert lookup.get('rs3') == () and len(queries) == 3
+        lookup.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
+
 if __name__ == '__main__':
     # set up the logger
     ch = logging.StreamHandler(stream=sys.stdout)
@@ -346,7 +501,7 @@ if __name__ == '__main__':
     parser.add_argument(
             '--reference',
             type = str,
-            help = 'Reference file for context annotation'
+            help = 'Reference file for context annotation, needs a samtools .fai index'
             )
     parser.add_argument(
         '--buffer',
@@ -355,8 +510,8 @@ if __name__ == '__main__':
         help='Buffer size for matching COSMIC records, defaults to 10bp')
     parser.add_argument(
         'COSMICVCF',
-        type=argparse.FileType('r'),
-        help='COSMIC vcf for annotation')
+        type=str,
+        help='COSMIC vcf for annotation, or a database compiled from it with cosmic_db.py')
     parser.add_argument(
         'INPUTVCF',
         type=argparse.FileType('r'),
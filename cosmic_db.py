@@ -0,0 +1,212 @@
+##
+# Compiled COSMIC annotation database
+#
+# annotate_vcf_cosmic.py only needs the position, REF and the AA, CDS and
+# CNT INFO values of each COSMIC site.  This compiles the COSMIC VCF once
+# into a flat binary file that is memory mapped when it is opened, so
+# opening it is nearly free and every worker on a node shares the same
+# pages of the page cache instead of parsing the VCF into its own heap.
+#
+# Layout (little endian):
+#   header:   MAGIC, number of contigs, offset of the sites, offset of the strings, source VCF name
+#   contigs:  name, index of the first site, number of sites
+#   sites:    POS, POS + len(REF), running max of the ends within the contig,
+#             string offset, string length (SITE struct)
+#   strings:  REF\tAA\tCDS\tCNT for each site
+#
+# Sites are sorted by POS within a contig so with the running max ends a
+# window query is two binary searches and a scan over the hits, the same
+# as hgsc_vcf.index.IntervalIndex but straight on the mapped file.
+
+import os, os.path, sys
+import struct
+import hgsc_vcf
+try:
+    import mmap
+except ImportError: # jython
+    mmap = None
+
+MAGIC = 'HGSCCDB1'
+HEADER = struct.Struct('<IQQH')
+CONTIG = struct.Struct('<HII')
+SITE = struct.Struct('<iiiIH')
+FIELDS = ('AA', 'CDS', 'CNT')
+
+def is_cosmic_db(path):
+    with open(path, 'rb') as fi:
+        return fi.read(len(MAGIC)) == MAGIC
+
+def _info_value(record, key):
+    value = record['INFO'].get(key)
+    if not value or value is True:
+        return '.'
+    return value[0]
+
+##
+# compiles the records of a COSMIC VCF reader into a database at opath
+def compile_db(reader, opath, source = ''):
+    contigs = [] # name, first, count
+    sites = []
+    strings = []
+    strings_len = 0
+    bychrom = {}
+    for record in reader:
+        bychrom.setdefault(record['CHROM'], []).append(record)
+    for chrom in sorted(bychrom.keys()):
+        records = sorted(bychrom[chrom], key = lambda r: r['POS'])
+        contigs.append((chrom, len(sites), len(records)))
+        maxend = None
+        for r in records:
+            end = r['POS'] + len(r['REF'])
+            if maxend is None or end > maxend:
+                maxend = end
+            s = '\t'.join([r['REF']] + [_info_value(r, k) for k in FIELDS])
+            sites.append(SITE.pack(r['POS'], end, maxend, strings_len, len(s)))
+            strings.append(s)
+            strings_len += len(s)
+    contig_table = ''.join([CONTIG.pack(len(c), first, count) + c for c, first, count in contigs])
+    sites_offset = len(MAGIC) + HEADER.size + len(source) + len(contig_table)
+    strings_offset = sites_offset + SITE.size * len(sites)
+    tmppath = opath + '.tmp'
+    with open(tmppath, 'wb') as fo:
+        fo.write(MAGIC)
+        fo.write(HEADER.pack(len(contigs), sites_offset, strings_offset, len(source)))
+        fo.write(source)
+        fo.write(contig_table)
+        fo.write(''.join(sites))
+        fo.write(''.join(strings))
+    os.rename(tmppath, opath)
+
+##
+# COSMIC sites from a compiled database
+#
+# intersect() works like VCFContainer.intersect and returns dict records
+# with CHROM, POS, REF and INFO AA, CDS and CNT for the matching sites.
+class CosmicDB(object):
+    def __init__(self, path, buffer):
+        self.path = path
+        self.buffer = buffer
+        self._fobj = open(path, 'rb')
+        if mmap is not None:
+            self._data = mmap.mmap(self._fobj.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self._data = self._fobj.read()
+        data = self._data
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a compiled COSMIC database" % path)
+        offset = len(MAGIC)
+        ncontigs, self._sites, self._strings, source_len = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        self.source = data[offset:offset + source_len]
+        offset += source_len
+        self.contigs = {}
+        for i in xrange(ncontigs):
+            name_len, first, count = CONTIG.unpack_from(data, offset)
+            offset += CONTIG.size
+            self.contigs[data[offset:offset + name_len]] = (first, count)
+            offset += name_len
+
+    def close(self):
+        if mmap is not None:
+            self._data.close()
+        self._fobj.close()
+
+    def _site(self, i):
+        return SITE.unpack_from(self._data, self._sites + i * SITE.size)
+
+    # first site in [lo, hi) where the field at index is above value (or >= with left)
+    def _bisect(self, lo, hi, field, value, left):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = self._site(mid)[field]
+            if v < value or (not left and v == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    ##
+    # (POS, end, REF, AA, CDS, CNT) of the sites overlapping [start, end]
+    def sites(self, chrom, start, end):
+        if chrom not in self.contigs:
+            return []
+        first, count = self.contigs[chrom]
+        lo = self._bisect(first, first + count, 2, start, True)
+        hi = self._bisect(lo, first + count, 0, end, False)
+        result = []
+        for i in xrange(lo, hi):
+            pos, send, maxend, soff, slen = self._site(i)
+            if send >= start:
+                soff += self._strings
+                result.append((pos, send) + tuple(self._data[soff:soff + slen].split('\t')))
+        return result
+
+    ##
+    # return a list of records within the indicated buffer limit
+    def intersect(self, record):
+        _pos = record['POS'] - self.buffer
+        _end = record['POS'] + len(record['REF']) + self.buffer
+        return [{'CHROM': record['CHROM'], 'POS': pos, 'REF': ref,
+                 'INFO': {'AA': [aa], 'CDS': [cds], 'CNT': [cnt]}}
+                for pos, send, ref, aa, cds, cnt in self.sites(record['CHROM'], _pos, _end)]
+
+def test():
+    import tempfile, shutil, random
+    from annotate_vcf_cosmic import VCFContainer
+    print "starting test"
+    random.seed(7)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # random sites on a few contigs, deletions of up to 60 bases so
+        # that long sites cover the short ones after them
+        lines = []
+        for chrom in ('1', '10', 'X'):
+            for i in xrange(2000):
+                pos = random.randint(1, 20000)
+                ref = 'ACGT'[i % 4] * random.choice((1, 1, 2, 5, 60))
+                info = 'AA=p.X%d;CDS=c.%d;CNT=%d' % (i, pos, i % 7)
+                if i % 50 == 0:
+                    info = 'CNT=1' # AA and CDS are missing
+                lines.append('\t'.join((chrom, str(pos), 'COSM%d' % i, ref, 'A', '.', '.', info)) + '\n')
+        random.shuffle(lines)
+        vcf = os.path.join(tmpdir, 'cosmic.vcf')
+        with open(vcf, 'w') as fo:
+            fo.write('##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            fo.writelines(lines)
+        dbpath = os.path.join(tmpdir, 'cosmic.cdb')
+        compile_db(hgsc_vcf.Reader(open(vcf, 'r'), compact = True), dbpath, 'cosmic.vcf')
+        assert is_cosmic_db(dbpath) and not is_cosmic_db(vcf)
+
+        def site(r):
+            return (r['CHROM'], r['POS'], r['REF']) + tuple([_info_value(r, k) for k in FIELDS])
+        for buffer in (0, 3, 100):
+            db = CosmicDB(dbpath, buffer)
+            assert db.source == 'cosmic.vcf' and sorted(db.contigs.keys()) == ['1', '10', 'X']
+            container = VCFContainer(hgsc_vcf.Reader(open(vcf, 'r')), buffer)
+            queries = [{'CHROM': random.choice(('1', '10', 'X', 'Y')), 'POS': random.randint(-100, 20100),
+                'REF': 'A' * random.choice((1, 3, 200))} for i in xrange(1000)]
+            # the contig edges
+            queries += [{'CHROM': '1', 'POS': 1, 'REF': 'A'}, {'CHROM': '1', 'POS': 20060, 'REF': 'A'}]
+            for q in queries:
+                expected = sorted([site(r) for r in container.intersect(q)])
+                assert sorted([site(r) for r in db.intersect(q)]) == expected, (buffer, q)
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
+
+def main(args):
+    reader = hgsc_vcf.Reader(hgsc_vcf.open_vcf(args.COSMICVCF), compact = True)
+    compile_db(reader, args.OUTPUT, os.path.basename(args.COSMICVCF))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('COSMICVCF', type = str, help = 'COSMIC vcf to compile')
+    parser.add_argument('OUTPUT', type = str, help = 'output database file')
+
+    args = parser.parse_args()
+
+    main(args)
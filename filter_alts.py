@@ -113,6 +113,7 @@ def main(args):
     writer.write_header()
     config = json.load(args.CONFIG)
     process_vcf(reader, writer, config)
+    writer.close()
     logger.info("Done")
 
 
@@ -13,26 +13,40 @@ def convert_record(record, convert, filter):
             record['INFO']['OF'] = ['|'.join(record['FILTER'])]
             record['FILTER'] = ['PASS']
 
-def main(args):
-    if args.level == 'all':
-        convert = SORTED_TIERS
-        filter = []
-    elif args.level in ['1','2','3','4','5']:
-        cut = int(args.level) - 1
-        convert = SORTED_TIERS[:cut]
-        filter = SORTED_TIERS[cut:]
+##
+# (tiers converted to PASS, tiers left filtered) for a level
+def tiers(level):
+    if level == 'all':
+        return SORTED_TIERS, []
+    elif level in ['1','2','3','4','5']:
+        cut = int(level) - 1
+        return SORTED_TIERS[:cut], SORTED_TIERS[cut:]
     else:
-        raise ValueError("%s is not a valid level" % args.level)
+        raise ValueError("%s is not a valid level" % level)
+
+def convert_records(records, convert, filter):
+    for record in records:
+        convert_record(record, convert, filter)
+        yield record
 
-    reader = hgsc_vcf.Reader(args.INPUT)
+##
+# filters the records of an hgsc_vcf.Reader as they are read
+#
+# returns the header for the filtered records and a generator of them
+def filter_vcf(reader, level = '5', command = None):
+    convert, filter = tiers(level)
     header = reader.header
     header.add_header('##INFO=<ID=OF,Number=1,Type=String,Description="original tiering call for this variant in this sample">')
-    header.add_header('##COMMAND=<ID=filter_muse.py,Params="%s">' % ' '.join(sys.argv))
+    header.add_header('##COMMAND=<ID=filter_muse.py,Params="%s">' % (command or '--level %s' % level))
+    return header, convert_records(reader, convert, filter)
+
+def main(args):
+    reader = hgsc_vcf.Reader(args.INPUT, lazy = True)
+    header, records = filter_vcf(reader, args.level, ' '.join(sys.argv))
     writer = hgsc_vcf.Writer(args.OUTPUT, header)
     writer.write_header()
-    for record in reader:
-        convert_record(record, convert, filter)
-        writer.write_record(record)
+    writer.write_records(records)
+    writer.close()
 
 
 
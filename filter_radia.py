@@ -1,12 +1,27 @@
 
 import os, os.path, sys
+import hgsc_vcf
+
+##
+# RADIA calls that are kept, the germline (SS=1) calls that PASS are dropped
+def keep_record(record):
+    return not ('PASS' in record['FILTER'] and record['INFO'].get('SS') == ['1'])
+
+##
+# filters the records of an hgsc_vcf.Reader as they are read
+#
+# returns the header for the filtered records and a generator of them
+def filter_vcf(reader):
+    return reader.header, (r for r in reader if keep_record(r))
 
 def main(args):
-    with open(args.INPUT, 'r') as fi, open(args.OUTPUT, 'w') as fo:
-        for line in fi.readlines():
-            if line[0] != '#' and 'SS=1' in line and 'PASS' in line:
-                continue
-            fo.write(line)
+    reader = hgsc_vcf.Reader(hgsc_vcf.open_vcf(args.INPUT, 'r'), lazy = True)
+    header, records = filter_vcf(reader)
+    writer = hgsc_vcf.Writer(hgsc_vcf.open_vcf(args.OUTPUT, 'w'), header)
+    writer.write_header()
+    writer.write_records(records)
+    writer.close()
+    reader.fobj.close()
 
 if __name__ == '__main__':
     import argparse
@@ -0,0 +1,267 @@
+##
+# BGZF (blocked gzip) reading and writing
+#
+# BGZF files are a series of gzip members of at most 64kb each, with the
+# compressed size of every member stored in a BC extra field.  Any gzip
+# reader can read them, and since every block can be found and inflated on
+# its own a position in the file is a virtual offset of
+# (block start << 16) | offset within the block.  This is the format used by
+# bgzip and tabix.
+#
+# BgzfWriter compresses blocks on a pool of threads (zlib lets go of the GIL
+# while it deflates) and writes them out in order.
+
+import struct, zlib
+import threading
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+MAGIC = '\x1f\x8b'
+# header of a BGZF block up to the BSIZE field
+_HEADER = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+EOF_BLOCK = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+MAX_BLOCK_DATA = 0xff00 # leaves room for incompressible data in a 64kb block
+
+def default_threads():
+    try:
+        import multiprocessing
+        return max(1, min(4, multiprocessing.cpu_count()))
+    except (ImportError, NotImplementedError):
+        return 1
+
+def compress_block(data, compresslevel = 6):
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    if len(cdata) + 26 > 0x10000:
+        # can happen with incompressible data, store it instead
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+    return ''.join((_HEADER, struct.pack('<H', len(cdata) + 25), cdata,
+        struct.pack('<iI', zlib.crc32(data), len(data) & 0xffffffff)))
+
+##
+# checks the first bytes of a file for the BGZF header
+#
+# returns 'bgzf', 'gzip' or None
+def sniff(head):
+    if head[:2] != MAGIC:
+        return None
+    if len(head) >= 16 and ord(head[3]) & 4 and head[12:14] == 'BC':
+        return 'bgzf'
+    return 'gzip'
+
+class _Job(object):
+    __slots__ = ('data', 'result', 'done')
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.done = threading.Event()
+
+##
+# file like object that writes BGZF blocks to fobj
+#
+# with threads > 1 up to 4 * threads blocks are compressed at once and
+# written out in order as they finish.
+class BgzfWriter(object):
+    def __init__(self, fobj, compresslevel = 6, threads = 1):
+        self.fobj = fobj
+        self.name = getattr(fobj, 'name', None)
+        self.compresslevel = compresslevel
+        self.threads = threads
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._workers = []
+        self._queue = None
+        if threads > 1:
+            self._queue = queue.Queue()
+            for i in range(threads):
+                t = threading.Thread(target = self._work)
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job.result = compress_block(job.data, self.compresslevel)
+            finally:
+                job.done.set()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= MAX_BLOCK_DATA:
+            data = ''.join(self._buffer)
+            end = len(data) - len(data) % MAX_BLOCK_DATA
+            for i in xrange(0, end, MAX_BLOCK_DATA):
+                self._submit(data[i:i + MAX_BLOCK_DATA])
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+
+    def _submit(self, data):
+        if self._queue is None:
+            self.fobj.write(compress_block(data, self.compresslevel))
+            return
+        job = _Job(data)
+        self._pending.append(job)
+        self._queue.put(job)
+        self._drain(len(self._pending) > 4 * self.threads)
+
+    def _drain(self, wait):
+        while self._pending and (wait or self._pending[0].done.is_set()):
+            job = self._pending.popleft()
+            job.done.wait()
+            if job.result is None:
+                raise IOError("Failed to compress BGZF block")
+            self.fobj.write(job.result)
+            wait = False
+
+    ##
+    # writes everything that was buffered, ending the current block
+    def flush(self):
+        if self._buffered:
+            self._submit(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        while self._pending:
+            self._drain(True)
+        self.fobj.flush()
+
+    def close(self):
+        if self.fobj.closed:
+            return
+        self.flush()
+        self.fobj.write(EOF_BLOCK)
+        for t in self._workers:
+            self._queue.put(None)
+        self.fobj.close()
+
+    @property
+    def closed(self):
+        return self.fobj.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+##
+# file like object that reads BGZF (or any concatenated gzip) data
+#
+# tell() and seek() use virtual offsets so that positions can be stored in
+# an index and jumped to later.
+class BgzfReader(object):
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.name = getattr(fobj, 'name', None)
+        self._block_start = 0
+        self._next_block = fobj.tell()
+        self._data = ''
+        self._pos = 0
+
+    def _load_block(self):
+        start = self._next_block
+        self.fobj.seek(start)
+        header = self.fobj.read(12)
+        if len(header) < 12:
+            self._block_start = start
+            self._data = ''
+            self._pos = 0
+            return False
+        if header[:2] != MAGIC:
+            raise IOError("Not a BGZF block at offset %s of %s" % (start, self.name))
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.fobj.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            si, slen = extra[i:i + 2], struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if si == 'BC':
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise IOError("Block at offset %s of %s is not BGZF" % (start, self.name))
+        cdata = self.fobj.read(bsize - xlen - 19)
+        crc, isize = struct.unpack('<iI', self.fobj.read(8))
+        data = zlib.decompress(cdata, -15)
+        if len(data) != isize:
+            raise IOError("Truncated BGZF block at offset %s of %s" % (start, self.name))
+        self._block_start = start
+        self._next_block = start + bsize + 1
+        self._data = data
+        self._pos = 0
+        return True
+
+    def tell(self):
+        return (self._block_start << 16) | self._pos
+
+    def seek(self, voffset, whence = 0):
+        if whence != 0:
+            raise IOError("BGZF files can only seek to virtual offsets")
+        block_start, pos = voffset >> 16, voffset & 0xffff
+        if block_start != self._block_start or not self._data:
+            self._next_block = block_start
+            self._load_block()
+        self._pos = pos
+
+    def readline(self):
+        parts = []
+        while True:
+            if self._pos >= len(self._data):
+                if not self._load_block():
+                    break
+                continue
+            i = self._data.find('\n', self._pos)
+            if i >= 0:
+                parts.append(self._data[self._pos:i + 1])
+                self._pos = i + 1
+                break
+            parts.append(self._data[self._pos:])
+            self._pos = len(self._data)
+        return ''.join(parts)
+
+    def read(self, size = -1):
+        parts = []
+        while size < 0 or size > 0:
+            if self._pos >= len(self._data):
+                if not self._load_block():
+                    break
+                continue
+            if size < 0:
+                chunk = self._data[self._pos:]
+            else:
+                chunk = self._data[self._pos:self._pos + size]
+                size -= len(chunk)
+            self._pos += len(chunk)
+            parts.append(chunk)
+        return ''.join(parts)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.fobj.close()
+
+    @property
+    def closed(self):
+        return self.fobj.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,152 @@
+##
+# Indexed FASTA reading
+#
+# FastaFile reads subsequences of a FASTA file through its samtools .fai
+# index, it is plain python so it works the same in CPython and Jython.
+# FastaWindow sits on top of it for sorted input: it reads a large window
+# of a contig at once and serves the following lookups from memory,
+# moving the window forward as the positions move past it.
+
+import os.path
+from collections import OrderedDict
+
+WINDOW = 1 << 20
+
+##
+# reads a .fai index into an OrderedDict of
+# contig: (length, offset, bases per line, bytes per line)
+def read_fai(path):
+    index = OrderedDict()
+    with open(path, 'r') as fi:
+        for line in fi:
+            if not line.strip():
+                continue
+            cols = line.rstrip('\r\n').split('\t')
+            index[cols[0]] = tuple([int(c) for c in cols[1:5]])
+    return index
+
+class FastaFile(object):
+    def __init__(self, path, fai = None):
+        self.path = path
+        if fai is None:
+            fai = path + '.fai'
+        if not os.path.isfile(fai):
+            raise IOError("No .fai index for %s, create one with samtools faidx" % path)
+        self.index = read_fai(fai)
+        self.fobj = open(path, 'rb')
+
+    def close(self):
+        self.fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def length(self, contig):
+        try:
+            return self.index[contig][0]
+        except KeyError:
+            raise KeyError("Contig %s is not in %s" % (contig, self.path))
+
+    ##
+    # bases of contig from start to end (1 based, inclusive)
+    #
+    # the range is clipped to the contig, the case of the bases is kept as
+    # it is in the file.
+    def fetch(self, contig, start, end):
+        try:
+            length, offset, linebases, linewidth = self.index[contig]
+        except KeyError:
+            raise KeyError("Contig %s is not in %s" % (contig, self.path))
+        start = max(start, 1) - 1
+        end = min(end, length)
+        if end <= start:
+            return ''
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases
+        self.fobj.seek(first)
+        data = self.fobj.read(last - first + 1)
+        return data.replace('\n', '').replace('\r', '')
+
+##
+# window cache over a FastaFile for lookups in sorted order
+#
+# a lookup outside of the current window reads window bases of the contig
+# starting at the lookup, so sorted input reads every part of the reference
+# it touches once, in large sequential reads.  Lookups out of order still
+# work, they just read a new window.
+class FastaWindow(object):
+    def __init__(self, fasta, window = WINDOW):
+        self.fasta = fasta
+        self.window = window
+        self.contig = None
+        self.start = 0
+        self.end = 0
+        self.bases = ''
+
+    def fetch(self, contig, start, end):
+        start = max(start, 1)
+        end = min(end, self.fasta.length(contig))
+        if end < start:
+            return ''
+        if contig != self.contig or start < self.start or end > self.end:
+            self.contig = contig
+            self.start = start
+            self.end = min(max(end, start + self.window - 1), self.fasta.length(contig))
+            self.bases = self.fasta.fetch(contig, self.start, self.end)
+        return self.bases[start - self.start:end - self.start + 1]
+
+    def close(self):
+        self.fasta.close()
+
+def test():
+    import tempfile, shutil, random
+    print "starting test"
+    random.seed(5)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # contigs of different line widths, one ending on a full line, and
+        # one with \r\n line ends
+        contigs = [('1', 60, '\n', 1000), ('2', 50, '\n', 500), ('3', 7, '\r\n', 101), ('4', 80, '\n', 5)]
+        seqs = {}
+        path = os.path.join(tmpdir, 'ref.fa')
+        offset = 0
+        with open(path, 'wb') as fo, open(path + '.fai', 'w') as fai:
+            for name, linebases, eol, length in contigs:
+                seq = ''.join([random.choice('ACGTacgtN') for i in xrange(length)])
+                seqs[name] = seq
+                header = '>%s description\n' % name
+                fo.write(header)
+                offset += len(header)
+                fai.write('%s\t%d\t%d\t%d\t%d\n' % (name, length, offset, linebases, linebases + len(eol)))
+                for i in xrange(0, length, linebases):
+                    fo.write(seq[i:i + linebases] + eol)
+                    offset += len(seq[i:i + linebases] + eol)
+
+        def expected(name, start, end):
+            return seqs[name][max(start, 1) - 1:max(end, 0)]
+        fasta = FastaFile(path)
+        window = FastaWindow(FastaFile(path), window = 64)
+        ranges = []
+        for i in xrange(5000):
+            name = random.choice(seqs.keys())
+            start = random.randint(-10, len(seqs[name]) + 10)
+            ranges.append((name, start, start + random.choice((0, 1, 5, 70, 200))))
+        ranges += [(name, 1, len(seqs[name])) for name in seqs] + [('1', 0, 0), ('1', 1000, 1000), ('1', 1001, 1010)]
+        # the window is slid by sorted lookups and replaced by the others
+        for name, start, end in ranges + sorted(ranges):
+            assert fasta.fetch(name, start, end) == expected(name, start, end), (name, start, end)
+            assert window.fetch(name, start, end) == expected(name, start, end), (name, start, end)
+        assert fasta.length('2') == 500
+        try:
+            fasta.fetch('5', 1, 10)
+            assert False
+        except KeyError:
+            pass
+        fasta.close()
+        window.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
@@ -0,0 +1,289 @@
+##
+# Tabix style genomic index for VCF files
+#
+# The index follows the tabix layout: every record is put in the smallest
+# UCSC bin that holds it and each bin keeps a list of file chunks
+# (begin, end offsets) that contain its records.  A linear index keeps the
+# smallest offset of a record overlapping each 16kb window so that chunks
+# that end before the query can be skipped.  Offsets are BGZF virtual
+# offsets for BGZF files and byte offsets for plain text files.
+#
+# The index is stored next to the VCF as <vcf>.hvi, a gzipped json file.
+
+import os, os.path
+import gzip, json
+import bisect
+from hgsc_vcf.bgzf import BgzfReader, sniff
+
+INDEX_EXTENSION = '.hvi'
+LINEAR_SHIFT = 14 # 16kb windows
+VERSION = 1
+
+##
+# bin of the smallest UCSC bin that contains [beg, end), 0 based
+def reg2bin(beg, end):
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+##
+# all bins that may hold records overlapping [beg, end), 0 based
+def reg2bins(beg, end):
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+##
+# 0 based [beg, end) span of a VCF line
+#
+# the span covers REF, or up to END for symbolic alleles that set it in INFO
+def record_span(cols):
+    beg = int(cols[1]) - 1
+    end = beg + max(len(cols[3]), 1)
+    if len(cols) > 7 and 'END=' in cols[7]:
+        for i in cols[7].split(';'):
+            if i.startswith('END='):
+                try:
+                    end = max(end, int(i[4:]))
+                except ValueError:
+                    pass
+    return beg, end
+
+class VCFIndex(object):
+    def __init__(self, bgzf = False):
+        self.bgzf = bgzf
+        self.contigs = {} # contig: {'bins': {bin: [[beg, end], ...]}, 'linear': [offset, ...]}
+        self.order = [] # contigs in the order they appear in the file
+        self.size = None
+        self.mtime = None
+
+    ##
+    # builds the index of a VCF file
+    #
+    # the file has to be sorted by position within each contig, contigs
+    # have to be contiguous but may come in any order.
+    @staticmethod
+    def build(path):
+        fobj = open(path, 'rb')
+        head = fobj.read(16)
+        fobj.seek(0)
+        kind = sniff(head)
+        if kind == 'gzip':
+            raise ValueError("%s is gzip but not BGZF compressed, it can not be indexed" % path)
+        if kind == 'bgzf':
+            fobj = BgzfReader(fobj)
+        index = VCFIndex(kind == 'bgzf')
+        try:
+            index._scan(fobj, path)
+        finally:
+            fobj.close()
+        index.size = os.path.getsize(path)
+        index.mtime = os.path.getmtime(path)
+        return index
+
+    def _scan(self, fobj, path):
+        contig = None
+        lastpos = 0
+        while True:
+            beg_off = fobj.tell()
+            line = fobj.readline()
+            if not line:
+                break
+            if line[0] == '#' or not line.strip():
+                continue
+            end_off = fobj.tell()
+            cols = line.split('\t', 8)
+            beg, end = record_span(cols)
+            if cols[0] != contig:
+                if cols[0] in self.contigs:
+                    raise ValueError("%s is not sorted, %s is not contiguous" % (path, cols[0]))
+                contig = cols[0]
+                lastpos = 0
+                bins = {}
+                linear = []
+                self.contigs[contig] = {'bins': bins, 'linear': linear}
+                self.order.append(contig)
+            if beg < lastpos:
+                raise ValueError("%s is not sorted at %s:%s" % (path, contig, beg + 1))
+            lastpos = beg
+            chunks = bins.setdefault(reg2bin(beg, end), [])
+            if chunks and chunks[-1][1] == beg_off:
+                chunks[-1][1] = end_off # extends the last chunk
+            else:
+                chunks.append([beg_off, end_off])
+            last_window = (end - 1) >> LINEAR_SHIFT
+            if len(linear) <= last_window:
+                linear.extend([None] * (last_window + 1 - len(linear)))
+            for w in xrange(beg >> LINEAR_SHIFT, last_window + 1):
+                if linear[w] is None:
+                    linear[w] = beg_off
+        # windows without records point at the next record
+        for data in self.contigs.values():
+            linear = data['linear']
+            nextoff = 0
+            for w in xrange(len(linear) - 1, -1, -1):
+                if linear[w] is None:
+                    linear[w] = nextoff
+                else:
+                    nextoff = linear[w]
+
+    ##
+    # file chunks that hold the records overlapping [beg, end), 0 based
+    def chunks(self, contig, beg, end):
+        data = self.contigs.get(contig)
+        if data is None:
+            return []
+        linear = data['linear']
+        if beg >> LINEAR_SHIFT >= len(linear):
+            return [] # past the end of the last record
+        minoff = linear[beg >> LINEAR_SHIFT]
+        chunks = []
+        bins = data['bins']
+        for b in reg2bins(beg, end):
+            for cbeg, cend in bins.get(b, ()):
+                if cend > minoff:
+                    chunks.append([max(cbeg, minoff), cend])
+        chunks.sort()
+        merged = []
+        for c in chunks:
+            if merged and c[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], c[1])
+            else:
+                merged.append(c)
+        return merged
+
+    def is_current(self, path):
+        return self.size == os.path.getsize(path) and self.mtime == os.path.getmtime(path)
+
+    def save(self, path):
+        data = {
+                'version': VERSION,
+                'bgzf': self.bgzf,
+                'order': self.order,
+                'size': self.size,
+                'mtime': self.mtime,
+                'contigs': {c: {'bins': [[b, chunks] for b, chunks in d['bins'].items()], 'linear': d['linear']}
+                    for c, d in self.contigs.items()}
+                }
+        tmppath = path + '.tmp'
+        fo = gzip.open(tmppath, 'wb')
+        try:
+            json.dump(data, fo)
+        finally:
+            fo.close()
+        os.rename(tmppath, path)
+
+    @staticmethod
+    def load(path):
+        fi = gzip.open(path, 'rb')
+        try:
+            data = json.load(fi)
+        finally:
+            fi.close()
+        if data.get('version') != VERSION:
+            raise ValueError("Unsupported index version in %s" % path)
+        index = VCFIndex(data['bgzf'])
+        index.order = [str(c) for c in data['order']]
+        index.size = data['size']
+        index.mtime = data['mtime']
+        for c, d in data['contigs'].items():
+            index.contigs[str(c)] = {'bins': {b: chunks for b, chunks in d['bins']}, 'linear': d['linear']}
+        return index
+
+##
+# In memory index for window queries over intervals
+#
+# intervals are sorted by start and each position also keeps the largest
+# end seen up to it.  Those running max ends are sorted too, so the first
+# interval that can reach a query start is found by bisection as well as the
+# last one that starts before the query end, which makes a query
+# O(log n + k).  Coordinates are inclusive.
+class IntervalIndex(object):
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key = lambda x: x[0])
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+        self.items = [i[2] for i in intervals]
+        self.maxends = []
+        maxend = None
+        for e in self.ends:
+            if maxend is None or e > maxend:
+                maxend = e
+            self.maxends.append(maxend)
+
+    def __len__(self):
+        return len(self.starts)
+
+    ##
+    # items of the intervals that overlap [start, end], in order of their start
+    def overlapping(self, start, end):
+        lo = bisect.bisect_left(self.maxends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        ends = self.ends
+        items = self.items
+        return [items[i] for i in xrange(lo, hi) if ends[i] >= start]
+
+##
+# returns the index of a VCF, building (and saving) it when it is missing or stale
+def load_index(path, build = True, save = True):
+    ipath = path + INDEX_EXTENSION
+    if os.path.isfile(ipath):
+        index = VCFIndex.load(ipath)
+        if index.is_current(path):
+            return index
+    if not build:
+        raise IOError("No current index for %s" % path)
+    index = VCFIndex.build(path)
+    if save:
+        try:
+            index.save(ipath)
+        except (IOError, OSError):
+            pass # read only location, the index is just rebuilt next time
+    return index
+
+def test():
+    import random
+    print "starting test"
+    random.seed(11)
+    # short and long intervals so that long ones cover the short after them
+    intervals = []
+    for i in xrange(3000):
+        start = random.randint(1, 50000)
+        intervals.append((start, start + random.choice((0, 0, 3, 40, 2000)), i))
+    index = IntervalIndex(intervals)
+    assert len(index) == len(intervals)
+    bystart = sorted(intervals, key = lambda x: x[0])
+    for n in xrange(2000):
+        start = random.randint(-100, 52100)
+        end = start + random.choice((0, 1, 10, 500))
+        expected = [i for s, e, i in bystart if s <= end and e >= start]
+        assert index.overlapping(start, end) == expected, (start, end)
+    assert IntervalIndex([]).overlapping(1, 10) == []
+    # coordinates are inclusive at both ends
+    index = IntervalIndex([(10, 20, 'a'), (15, 15, 'b')])
+    assert index.overlapping(20, 30) == ['a'] and index.overlapping(1, 10) == ['a']
+    assert index.overlapping(15, 15) == ['a', 'b'] and index.overlapping(21, 30) == []
+    print "Success"
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('VCF', nargs = '+', type = str, help = 'sorted BGZF or plain text vcf files to index')
+
+    args = parser.parse_args()
+
+    for path in args.VCF:
+        VCFIndex.build(path).save(path + INDEX_EXTENSION)
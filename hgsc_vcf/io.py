@@ -1,26 +1,37 @@
 
-import csv
+import csv, gzip
+import os.path
 from hgsc_vcf.metainfo import *
+from hgsc_vcf.bgzf import BgzfReader, BgzfWriter, default_threads, sniff
+from hgsc_vcf.index import load_index, record_span
+from hgsc_vcf.record import Record, LazyRecord, CallView, parse_info_field, parse_sample
 from collections import *
 
+##
+# VCF reader
+#
+# BGZF and gzip input is detected from the first bytes of fobj and read
+# transparently.
+#
+# records are OrderedDicts keyed by the VCF columns.  With lazy = True the
+# reader returns LazyRecords instead, these only parse INFO, FORMAT and
+# SAMPLES (or any other column) when they are first used, which is much
+# cheaper for passes that only look at CHROM, POS or FILTER.  With
+# compact = True the records are fully parsed into slotted Records, which
+# take a fraction of the memory when many records are held at once.
+#
+# fetch() gives random access by region through a tabix style index.
 class Reader(object):
-    def __init__(self, fobj):
-        self.fobj = fobj
+    def __init__(self, fobj, lazy = False, compact = False):
+        self.fobj = wrap_input(fobj)
+        self.lazy = lazy
+        self.compact = compact
         self.header = VCFHeader()
         self.header.load(self.fobj)
         self._next = None
+        self.index = None
     
-    @staticmethod
-    def parse_info_field(info):
-        infos = info.split(';')
-        result = OrderedDict()
-        for i in infos:
-            if '=' in i:
-                k, v = i.split('=',1)
-                result[k] = v.split(',')
-            else:
-                result[i] = True # True indicates that the flag is active
-        return result
+    parse_info_field = staticmethod(parse_info_field)
 
     def peek(self):
         return self._next
@@ -33,18 +44,73 @@ class Reader(object):
             pass # swallow the error
         return old
 
-    @staticmethod
-    def parse_sample(format_keys, slist):
-        return OrderedDict(zip(format_keys, [i.split(',') for i in slist]))
+    parse_sample = staticmethod(parse_sample)
     
     def __iter__(self):
         return self
 
     def next(self):
-        line = [c.strip() for c in self.fobj.readline().split('\t')]
-        if len(line) < 1 or line[0] == '':
+        record = self._parse_line(self.fobj.readline())
+        if record is None:
             self._next = None
             raise StopIteration
+        self._next = record
+        return record
+
+    ##
+    # yields the records overlapping chrom:start-end (1 based, inclusive)
+    #
+    # This needs a BGZF or plain text VCF on disk that is sorted by position
+    # within each contig.  The index is read from <vcf>.hvi, or built (and
+    # saved) if that is missing or older than the VCF.  The records are read
+    # through a file handle of their own and parsed as they are yielded, so
+    # a whole contig is never held in memory and the reading position used
+    # by next() is not touched.  The handle is closed when the region is
+    # done or the generator is closed.
+    def fetch(self, chrom, start = None, end = None):
+        path = getattr(self.fobj, 'name', None)
+        if self.index is None:
+            if isinstance(self.fobj, gzip.GzipFile) or not isinstance(path, basestring) or not os.path.isfile(path):
+                raise ValueError("fetch needs a BGZF or plain text file on disk")
+            self.index = load_index(path)
+        beg = 0 if start is None else max(start - 1, 0)
+        end = MAX_POSITION if end is None else end
+        fobj = open(path, 'rb')
+        if self.index.bgzf:
+            fobj = BgzfReader(fobj)
+        try:
+            for cbeg, cend in self.index.chunks(chrom, beg, end):
+                fobj.seek(cbeg)
+                while fobj.tell() < cend:
+                    line = fobj.readline()
+                    if not line:
+                        break
+                    cols = line.split('\t', 8)
+                    if cols[0] != chrom:
+                        continue
+                    rbeg, rend = record_span(cols)
+                    if rbeg >= end:
+                        break
+                    if rend > beg:
+                        yield self._parse_line(line)
+        finally:
+            fobj.close()
+
+    def _parse_line(self, line):
+        if self.lazy or self.compact:
+            line = line.rstrip('\r\n').split('\t')
+            if line[0].strip() == '':
+                return None
+            if self.lazy:
+                return LazyRecord(line, self.header.samples)
+            try:
+                return Record(line, self.header.samples)
+            except:
+                print line
+                raise
+        line = [c.strip() for c in line.split('\t')]
+        if len(line) < 1 or line[0] == '':
+            return None
         try:
             record = OrderedDict()
             for k, v in (
@@ -65,65 +131,379 @@ class Reader(object):
                         self.header.samples, 
                         [Reader.parse_sample(record['FORMAT'], s.split(':')) for s in line[9:]]
                         ))
-            self._next = record
             return record
         except:
             print line
             raise
 
+WRITE_BUFFER = 1 << 20
+
+##
+# VCF writer
+#
+# The record formatter is put together once for the header and its samples
+# when the header is written.  write_records takes any iterable of records
+# and writes them out in blocks of about WRITE_BUFFER bytes, nothing is
+# left in its buffer when it returns.
+#
+# By default write_record and write_line go straight to fobj.  With
+# buffer_size set lines are held back until buffer_size bytes are waiting,
+# then flush() or close() (or using the writer as a context manager) is
+# needed when done or the tail of the buffer is lost.
+#
+# Files named .gz or .bgz are written as BGZF, compressed on threads threads.
 class Writer(object):
-    def __init__(self, fobj, header):
+    def __init__(self, fobj, header, buffer_size = 0, threads = None):
         assert isinstance(header, VCFHeader), "header must be a VCFHeader"
         self.header = header
         self.header_written = False
-        self.fobj = fobj
+        self.fobj = wrap_output(fobj, threads)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._format_record = None
 
     def write_header(self):
         if self.header_written:
             raise ValueError("Can't write the header twice")
         for h in self.header.headers:
-            self.fobj.write(str(h) + '\n')
+            self._write(str(h) + '\n')
         header_cols = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
         if len(self.header.samples) > 0:
             header_cols.append('FORMAT')
             for s in self.header.samples:
                 header_cols.append(s)
-        self.fobj.write('#' + '\t'.join(header_cols) + '\n')
+        self._write('#' + '\t'.join(header_cols) + '\n')
+        self._format_record = _compile_formatter(self.header.samples)
         self.header_written = True
 
+    def _write(self, line):
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            self.fobj.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def format_record(self, record):
+        if not self.header_written:
+            raise ValueError("Must write the header first")
+        return self._format_record(record)
+
     def write_record(self, record):
         if not self.header_written:
             raise ValueError("Must write the header first")
+        self._write(self._format_record(record))
+
+    ##
+    # writes a line that is already formatted, ending in a newline
+    def write_line(self, line):
+        if not self.header_written:
+            raise ValueError("Must write the header first")
+        self._write(line)
+
+    def write_records(self, records):
+        if not self.header_written:
+            raise ValueError("Must write the header first")
+        format_record = self._format_record
+        buffer_size = max(self.buffer_size, WRITE_BUFFER)
+        for record in records:
+            line = format_record(record)
+            self._buffer.append(line)
+            self._buffered += len(line)
+            if self._buffered >= buffer_size:
+                self._flush_buffer()
+        self._flush_buffer()
+
+    def flush(self):
+        self._flush_buffer()
+        self.fobj.flush()
+
+    def close(self):
+        self._flush_buffer()
+        self.fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+BGZF_EXTENSIONS = ('.gz', '.bgz')
+MAX_POSITION = 1 << 29 # largest position a tabix style index can hold
+
+##
+# wraps a file object opened for reading so that BGZF and gzip data are inflated
+#
+# the first bytes are checked for the gzip magic, file objects that can not
+# seek back (pipes) are returned as they are.
+def wrap_input(fobj):
+    if isinstance(fobj, (BgzfReader, gzip.GzipFile)):
+        return fobj
+    try:
+        start = fobj.tell()
+        head = fobj.read(16)
+        fobj.seek(start)
+    except (IOError, AttributeError, ValueError):
+        return fobj
+    kind = sniff(head)
+    if kind == 'bgzf':
+        return BgzfReader(fobj)
+    elif kind == 'gzip':
+        return gzip.GzipFile(fileobj = fobj)
+    return fobj
+
+##
+# wraps a file object opened for writing in a BgzfWriter if it is named .gz or .bgz
+def wrap_output(fobj, threads = None):
+    if isinstance(fobj, BgzfWriter):
+        return fobj
+    name = getattr(fobj, 'name', None)
+    if isinstance(name, basestring) and name.endswith(BGZF_EXTENSIONS):
+        return BgzfWriter(fobj, threads = threads or default_threads())
+    return fobj
+
+##
+# opens a VCF path for reading or writing
+#
+# reading detects BGZF and gzip from the file contents, writing to a path
+# ending in .gz or .bgz produces BGZF.
+def open_vcf(path, mode = 'r', threads = None):
+    if 'r' in mode:
+        return wrap_input(open(path, 'rb'))
+    return wrap_output(open(path, mode.replace('b', '') + 'b'), threads)
+
+_FIXED_COLUMNS = (('CHROM', None), ('POS', None), ('ID', ';'), ('REF', None), ('ALT', ','), ('QUAL', None), ('FILTER', ';'))
+
+def _join_value(v):
+    # values are lists, or the raw string for Records that were read from a file
+    if isinstance(v, basestring):
+        return v
+    return ','.join(v)
+
+def _format_info(keys, values):
+    info_parts = []
+    for k, v in zip(keys, values):
+        if k == '.' and len(keys) > 1:
+            continue # this is a leftover empty marker
+        if v is True:
+            info_parts.append(k)
+        else:
+            info_parts.append('%s=%s' % (k, _join_value(v)))
+    return ';'.join(info_parts)
+
+##
+# builds the record formatter for a list of samples
+#
+# Records are formatted straight from their slots, columns of a LazyRecord
+# that were never decoded are written as they were read.  Anything else is
+# treated like the OrderedDict records.
+def _compile_formatter(samples):
+    samples = list(samples)
+    nsamples = len(samples)
+    sample_range = range(nsamples)
+
+    def format_fixed(record, raw):
         field_parts = []
-        for k, joiner in (('CHROM', None), ('POS', None), ('ID', ';'), ('REF', None), ('ALT', ','), ('QUAL', None), ('FILTER', ';')):
+        for k, joiner in _FIXED_COLUMNS:
+            r = raw(k) if raw else None
+            if r is not None:
+                field_parts.append(r)
+                continue
+            v = record[k]
             if joiner:
                 try:
-                    field_parts.append(joiner.join(record[k]))
+                    field_parts.append(joiner.join(v))
                 except:
-                    print k, joiner, record[k]
+                    print k, joiner, v
                     raise
             else:
-                field_parts.append(str(record[k]))
-        # info is a bit trickier
-        info_parts = []
-        for k, v in record['INFO'].items():
-            if k == '.' and len(record['INFO']) > 1:
-                continue # this is a leftover empty marker
-            if isinstance(v, list):
-                info_parts.append('%s=%s' % (k, ','.join(v)))
+                field_parts.append(str(v))
+        return field_parts
+
+    def format_compact(record):
+        raw = record.raw
+        field_parts = format_fixed(record, raw)
+        r = raw('INFO')
+        if r is None:
+            r = _format_info(record._info[0::2], record._info[1::2])
+        field_parts.append(r)
+        if nsamples > 0:
+            raw_format = raw('FORMAT')
+            raw_samples = None
+            if raw_format is not None and record._samples == samples:
+                raw_samples = raw('SAMPLES')
+            if raw_samples is not None:
+                field_parts.append(raw_format)
+                field_parts.append(raw_samples)
             else:
-                info_parts.append(k)
-        field_parts.append(';'.join(info_parts))
-        if len(self.header.samples) > 0:
-            field_parts.append(':'.join(record['FORMAT']))
-            for s in self.header.samples:
-                sinfo = record['SAMPLES'][s]
+                format_keys = record['FORMAT']
+                record['SAMPLES'] # make sure that the samples are decoded
+                names = record._names
+                if names == samples:
+                    indexes = sample_range
+                else:
+                    try:
+                        indexes = [names.index(s) for s in samples]
+                    except ValueError:
+                        print names
+                        raise KeyError("Record is missing samples from the header")
+                columns = [record._calls.get(k) for k in format_keys]
+                field_parts.append(':'.join(format_keys))
+                for i in indexes:
+                    try:
+                        field_parts.append(':'.join([_join_value(c[i]) for c in columns]))
+                    except:
+                        print CallView(record, i)
+                        raise KeyError("Sample is missing FORMAT values")
+        return '\t'.join(field_parts) + '\n'
+
+    def format_mapping(record):
+        field_parts = format_fixed(record, None)
+        info = record['INFO']
+        field_parts.append(_format_info(info.keys(), info.values()))
+        if nsamples > 0:
+            format_keys = record['FORMAT']
+            field_parts.append(':'.join(format_keys))
+            record_samples = record['SAMPLES']
+            for s in samples:
+                sinfo = record_samples[s]
                 # sinfo is a dict (OrderedDict ideally)
                 try:
-                    field_parts.append(':'.join([','.join(sinfo[k]) for k in record['FORMAT']]))
+                    field_parts.append(':'.join([_join_value(sinfo[k]) for k in format_keys]))
                 except:
                     print sinfo
                     raise
-        self.fobj.write('\t'.join(field_parts) + '\n')
+        return '\t'.join(field_parts) + '\n'
+
+    def format_record(record):
+        if isinstance(record, Record):
+            return format_compact(record)
+        return format_mapping(record)
+    return format_record
+
+TEST_HEADER = '''##fileformat=VCFv4.1
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tPRIMARY
+'''
+
+##
+# lines of a sorted test VCF, n records on each of contigs 1, 2 and X
+# with REFs of 1 to 5 bases
+def _test_lines(n):
+    for chrom in ('1', '2', 'X'):
+        for i in xrange(n):
+            yield '\t'.join([chrom, str(1 + i * 3), '.', 'ACGTA'[:1 + i % 5], 'T', '.', 'PASS', '.', 'GT', '0/0', '0/1']) + '\n'
+
+def test():
+    import tempfile, shutil
+    print "starting test"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmpdir, 't.vcf')
+        with open(plain, 'w') as fo:
+            fo.write(TEST_HEADER)
+            fo.writelines(_test_lines(20000))
+        bgzf = os.path.join(tmpdir, 't.vcf.gz')
+        reader = Reader(open(plain, 'r'))
+        writer = Writer(open(bgzf, 'w'), reader.header)
+        writer.write_header()
+        for line in iter(reader.fobj.readline, ''):
+            writer.write_line(line)
+        writer.close()
+        reader.fobj.close()
 
+        for path in (plain, bgzf):
+            reader = Reader(open(path, 'rb'), lazy = True)
+            records = [(r['CHROM'], r['POS'], r['REF']) for r in reader]
+            reader.fobj.close()
+            # region queries match a scan of the whole file
+            reader = Reader(open(path, 'rb'))
+            first = reader.next()
+            for chrom, start, end in (('2', None, None), ('1', 1000, 2000), ('X', 59990, 70000), ('1', 1, 1), ('Y', 1, 10)):
+                expected = [x for x in records if x[0] == chrom and
+                        (start is None or (x[1] + len(x[2]) - 1 >= start and x[1] <= end))]
+                assert [(r['CHROM'], r['POS'], r['REF']) for r in reader.fetch(chrom, start, end)] == expected, (path, chrom, start, end)
+            # the reading position of the reader is left alone
+            assert (first['POS'], reader.next()['POS']) == (1, 4)
+            reader.fobj.close()
+            assert os.path.isfile(path + '.hvi')
 
+        # with buffer_size the Writer holds lines back until that many bytes
+        # are waiting, write_records leaves nothing behind and the output
+        # does not depend on the buffer size
+        with open(plain, 'r') as fi:
+            text = fi.read()
+        first = text.index('\n1\t4\t') + 1 # the header and the first record
+        for buffer_size in (0, 1, 1 << 10, 1 << 24):
+            reader = Reader(open(plain, 'r'), lazy = True)
+            path = os.path.join(tmpdir, 'b.vcf')
+            writer = Writer(open(path, 'w'), reader.header, buffer_size = buffer_size)
+            writer.write_header()
+            writer.write_record(reader.next())
+            writer.fobj.flush()
+            if buffer_size != 1 << 10:
+                assert os.path.getsize(path) == (0 if buffer_size > len(text) else first), buffer_size
+            writer.write_records(reader)
+            writer.fobj.flush()
+            assert os.path.getsize(path) == len(text), buffer_size
+            writer.close()
+            reader.fobj.close()
+            with open(path, 'r') as fi:
+                assert fi.read() == text, buffer_size
+        # BGZF round trips, on one or more compression threads
+        from hgsc_vcf.bgzf import EOF_BLOCK
+        for threads in (1, 3):
+            path = os.path.join(tmpdir, 'r%d.vcf.gz' % threads)
+            fo = open_vcf(path, 'w', threads)
+            for i in xrange(0, len(text), 7777): # writes that do not line up with the blocks
+                fo.write(text[i:i + 7777])
+            fo.close()
+            with open(path, 'rb') as fi:
+                data = fi.read()
+            assert sniff(data[:16]) == 'bgzf' and data.endswith(EOF_BLOCK)
+            assert data.count('\x1f\x8b\x08\x04') > 10 # many blocks
+            fi = open_vcf(path)
+            assert fi.read() == text, threads
+            fi.close()
+            # virtual offsets taken while reading can be seeked back to
+            fi = open_vcf(path)
+            marks = []
+            for n, line in enumerate(iter(fi.readline, '')):
+                if n % 5000 == 0:
+                    marks.append((fi.tell(), fi.readline()))
+            for voffset, line in reversed(marks):
+                fi.seek(voffset)
+                assert fi.readline() == line
+            fi.close()
+        # plain gzip is read too
+        path = os.path.join(tmpdir, 'g.vcf.gz')
+        fo = gzip.open(path, 'wb')
+        fo.write(text)
+        fo.close()
+        fi = open_vcf(path)
+        assert not isinstance(fi, BgzfReader) and fi.read() == text
+        fi.close()
+        # values changed in place are written out, for every kind of record
+        line = '1\t10\t.\tA\tT\t.\tPASS\tDP=3;DB\tGT:AD\t0/0:5,0\t0/1:4,2\n'
+        for lazy, compact in ((False, False), (True, False), (False, True)):
+            reader = Reader(open(plain, 'r'), lazy = lazy, compact = compact)
+            record = reader._parse_line(line)
+            record['INFO']['DP'].append('4')
+            record['SAMPLES']['PRIMARY']['AD'][0] = '9'
+            writer = Writer(open(os.path.join(tmpdir, 'm.vcf'), 'w'), reader.header)
+            writer.write_header()
+            assert writer.format_record(record) == line.replace('DP=3', 'DP=3,4').replace('0/1:4,2', '0/1:9,2'), (lazy, compact)
+            # assigning a record its own INFO and SAMPLES changes nothing
+            record['INFO'] = record['INFO']
+            record['SAMPLES'] = record['SAMPLES']
+            assert writer.format_record(record) == line.replace('DP=3', 'DP=3,4').replace('0/1:4,2', '0/1:9,2'), (lazy, compact)
+            writer.close()
+            reader.fobj.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
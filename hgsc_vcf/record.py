@@ -0,0 +1,447 @@
+import collections
+from collections import OrderedDict
+
+COLUMNS = ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', 'SAMPLES')
+
+##
+# parse an INFO column into an OrderedDict
+#
+# values are split on , and flags are set to True
+def parse_info_field(info):
+    infos = info.split(';')
+    result = OrderedDict()
+    for i in infos:
+        if '=' in i:
+            k, v = i.split('=',1)
+            result[k] = v.split(',')
+        else:
+            result[i] = True # True indicates that the flag is active
+    return result
+
+def parse_sample(format_keys, slist):
+    return OrderedDict(zip(format_keys, [i.split(',') for i in slist]))
+
+##
+# dict methods for the record classes
+#
+# collections.MutableMapping would do the same but it gives every instance
+# a __dict__, which is exactly what the slotted classes below avoid.
+class _MappingMixin(object):
+    __slots__ = ()
+
+    def keys(self):
+        return [k for k in self]
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for k in self:
+            yield self[k]
+
+    def iteritems(self):
+        for k in self:
+            yield k, self[k]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        return sum(1 for k in self)
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    _marker = object()
+    def pop(self, key, default = _marker):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is _MappingMixin._marker:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def update(self, other = (), **kwargs):
+        if hasattr(other, 'keys'):
+            for k in other.keys():
+                self[k] = other[k]
+        else:
+            for k, v in other:
+                self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+##
+# INFO accessor for a Record
+#
+# INFO is stored on the record as a flat [key, value, key, value, ...] list,
+# values are kept as the raw string until they are looked up.  The first
+# lookup splits the value and stores the list in its place, so changes made
+# to it in place (.append and so on) are written out like the OrderedDict
+# records.
+class InfoView(_MappingMixin):
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        self._record = record
+
+    def _find(self, key):
+        info = self._record._info
+        for i in xrange(0, len(info), 2):
+            if info[i] == key:
+                return i
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        info = self._record._info
+        v = info[i + 1]
+        if isinstance(v, basestring):
+            v = info[i + 1] = v.split(',')
+        return v
+
+    def __setitem__(self, key, value):
+        i = self._find(key)
+        if i < 0:
+            self._record._info.extend((key, value))
+        else:
+            self._record._info[i + 1] = value
+
+    def __delitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        del self._record._info[i:i + 2]
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return iter(self._record._info[0::2])
+
+    def __len__(self):
+        return len(self._record._info) // 2
+
+##
+# FORMAT values of a single sample of a Record
+#
+# like InfoView the raw value is split on the first lookup and the list
+# kept, so it can be changed in place.
+class CallView(_MappingMixin):
+    __slots__ = ('_record', '_index')
+
+    def __init__(self, record, index):
+        self._record = record
+        self._index = index
+
+    def __getitem__(self, key):
+        column = self._record._calls.get(key)
+        if column is None or column[self._index] is None:
+            raise KeyError(key)
+        v = column[self._index]
+        if isinstance(v, basestring):
+            v = column[self._index] = v.split(',')
+        return v
+
+    def __setitem__(self, key, value):
+        calls = self._record._calls
+        if key not in calls:
+            calls[key] = [None] * len(self._record._names)
+        calls[key][self._index] = value
+
+    def __delitem__(self, key):
+        column = self._record._calls.get(key)
+        if column is None or column[self._index] is None:
+            raise KeyError(key)
+        column[self._index] = None
+
+    def __iter__(self):
+        calls = self._record._calls
+        i = self._index
+        format_keys = self._record.get('FORMAT') or []
+        for k in format_keys:
+            if k in calls and calls[k][i] is not None:
+                yield k
+        for k, column in calls.items():
+            if k not in format_keys and column[i] is not None:
+                yield k
+
+##
+# SAMPLES accessor for a Record
+#
+# sample values are stored column wise on the record, one list per FORMAT key
+# holding the value for each sample, so there is no dict per sample.  Looking
+# up a sample returns a CallView over its position in those lists.
+class SampleView(_MappingMixin):
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getitem__(self, name):
+        try:
+            return CallView(self._record, self._record._names.index(name))
+        except ValueError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        record = self._record
+        items = value.items() # take a copy, value may be a view on this record
+        if name in record._names:
+            index = record._names.index(name)
+            for k in record._calls:
+                record._calls[k][index] = None
+        else:
+            index = len(record._names)
+            record._names = record._names + [name] # the names list is shared with the header
+            for column in record._calls.values():
+                column.append(None)
+        call = CallView(record, index)
+        for k, v in items:
+            call[k] = v
+
+    def __delitem__(self, name):
+        record = self._record
+        try:
+            index = record._names.index(name)
+        except ValueError:
+            raise KeyError(name)
+        record._names = record._names[:index] + record._names[index + 1:]
+        for column in record._calls.values():
+            del column[index]
+
+    def __contains__(self, name):
+        return name in self._record._names
+
+    def __iter__(self):
+        return iter(self._record._names)
+
+    def __len__(self):
+        return len(self._record._names)
+
+##
+# Compact VCF record
+#
+# A slotted replacement for the nested OrderedDict records.  CHROM through
+# FILTER and FORMAT are stored as attributes, INFO as a flat key/value list
+# and the sample data column wise per FORMAT key.  record['INFO'] and
+# record['SAMPLES'] return views over that storage that behave like the
+# OrderedDicts the Reader used to build, so existing code keeps working.
+class Record(_MappingMixin):
+    __slots__ = ('CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'FORMAT',
+            '_info', '_names', '_calls', '_keys', '_extra')
+
+    def __init__(self, line = None, samples = None):
+        self._keys = ()
+        self._extra = None
+        if line is not None:
+            self._keys = COLUMNS[:min(len(line), len(COLUMNS))]
+            for k in self._keys:
+                _DECODERS[k](self, line, samples)
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            if key == 'INFO':
+                return InfoView(self)
+            elif key == 'SAMPLES':
+                return SampleView(self)
+            elif key in _DECODERS:
+                return getattr(self, key)
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        # take a copy first, value may be a view on this record
+        if key == 'INFO':
+            items = value.items()
+            self._info = []
+            for k, v in items:
+                self._info.extend((k, v))
+        elif key == 'SAMPLES':
+            items = [(name, sinfo.items()) for name, sinfo in value.items()]
+            self._names = []
+            self._calls = {}
+            view = SampleView(self)
+            for name, sinfo in items:
+                view[name] = OrderedDict(sinfo)
+        elif key in _DECODERS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        if key not in self._keys:
+            self._keys = self._keys + (key,)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys = tuple([k for k in self._keys if k != key])
+        if self._extra is not None:
+            self._extra.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    ##
+    # the column as it was read, None once it has been decoded
+    def raw(self, key):
+        return None
+
+    def __getstate__(self):
+        return [getattr(self, s, None) for s in _all_slots(self.__class__)]
+
+    def __setstate__(self, state):
+        for s, v in zip(_all_slots(self.__class__), state):
+            setattr(self, s, v)
+
+def _all_slots(cls):
+    return [s for c in reversed(cls.__mro__) for s in getattr(c, '__slots__', ())]
+
+def _decode_info(record, line, samples):
+    info = []
+    for i in line[7].strip().split(';'):
+        if '=' in i:
+            info.extend(i.split('=', 1))
+        else:
+            info.extend((i, True)) # True indicates that the flag is active
+    record._info = info
+
+def _decode_samples(record, line, samples):
+    format_keys = line[8].strip().split(':')
+    columns = line[9:]
+    n = min(len(samples), len(columns))
+    calls = {}
+    for i in xrange(n):
+        for k, v in zip(format_keys, columns[i].strip().split(':')):
+            if k not in calls:
+                calls[k] = [None] * n
+            calls[k][i] = v
+    record._names = samples if n == len(samples) else samples[:n]
+    record._calls = calls
+
+def _setter(key, decode):
+    def _decode(record, line, samples):
+        setattr(record, key, decode(line))
+    return _decode
+
+# decoders for each of the COLUMNS, these fill in the slots of a Record
+_DECODERS = {
+        'CHROM': _setter('CHROM', lambda line: line[0].strip()),
+        'POS': _setter('POS', lambda line: int(line[1])),
+        'ID': _setter('ID', lambda line: line[2].strip().split(';')),
+        'REF': _setter('REF', lambda line: line[3].strip()),
+        'ALT': _setter('ALT', lambda line: line[4].strip().split(',')),
+        'QUAL': _setter('QUAL', lambda line: float(line[5]) if line[5].strip() != '.' else '.'),
+        'FILTER': _setter('FILTER', lambda line: line[6].strip().split(';')),
+        'INFO': _decode_info,
+        'FORMAT': _setter('FORMAT', lambda line: line[8].strip().split(':')),
+        'SAMPLES': _decode_samples
+        }
+
+##
+# VCF record that is decoded on demand
+#
+# The tab split line is kept as is and each column is only parsed into the
+# Record storage the first time that it is looked up.  Otherwise this
+# behaves like a Record, decoded values are kept so that modifications
+# (record['INFO']['OF'] = ...) stick.
+#
+# Columns that were never decoded are available through raw() so that a
+# Writer can pass them through without formatting them again.
+class LazyRecord(Record):
+    __slots__ = ('_line', '_samples', '_pending')
+
+    def __init__(self, line, samples):
+        Record.__init__(self)
+        self._line = line
+        self._samples = samples
+        # 8 columns stop at INFO, 9 add FORMAT and 10 or more add SAMPLES
+        self._keys = COLUMNS[:min(len(line), len(COLUMNS))]
+        self._pending = self._keys
+
+    def _settle(self, key):
+        self._pending = tuple([k for k in self._pending if k != key])
+        if not self._pending:
+            self._line = None # everything is decoded, drop the line
+
+    def _decode(self, key):
+        try:
+            _DECODERS[key](self, self._line, self._samples)
+        except:
+            print self._line
+            raise
+        self._settle(key)
+
+    def raw(self, key):
+        if key not in self._pending:
+            return None
+        if key == 'SAMPLES':
+            return '\t'.join([s.strip() for s in self._line[9:]])
+        return self._line[COLUMNS.index(key)].strip()
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self._decode(key)
+        return Record.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        # the old value is replaced so there is no need to decode it
+        self._settle(key)
+        Record.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        Record.__delitem__(self, key)
+        self._settle(key)
+
+for _cls in (InfoView, CallView, SampleView, Record, LazyRecord):
+    collections.MutableMapping.register(_cls)
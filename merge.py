@@ -4,9 +4,12 @@
 # "wrapper" utility for VCF merge and MAF generation
 
 import os, os.path, sys
-import tempfile, re
+import tempfile, re, imp
 import hgsc_vcf
-import subprocess, traceback, shutil
+import annotate_vcf_cosmic
+import filter_muse, filter_radia
+from mergesort import mergesort
+import subprocess, traceback, shutil, time
 
 import smtplib
 from email.mime.text import MIMEText
@@ -51,82 +54,117 @@ logger.addHandler(ch)
 
 PACKAGEDIR = os.path.dirname(os.path.abspath(__file__))
 
+# the hyphenated scripts can't be imported by name
+vcf_sort = imp.load_source('vcf_sort', os.path.join(PACKAGEDIR, 'vcf-sort.py'))
+vcf_merge = imp.load_source('vcf_merge', os.path.join(PACKAGEDIR, 'vcf-merge.py'))
+
+# the annotation, sort and merge run in process, their progress and record
+# errors go to the job log too
+for _module in (annotate_vcf_cosmic, vcf_sort, vcf_merge):
+    _module.logger.addHandler(ch)
+# the merge logs every record at DEBUG, keep it at INFO like vcf-merge.py did
+vcf_merge.logger.setLevel(logging.INFO)
+
+SEQDICT = '/hgsc_software/cancer-analysis/resources/references/human/hg19/hg19.dict'
+
+REFERENCE = '/hgsc_software/cancer-analysis/resources/references/human/hg19/hg19.fa'
+COSMIC = '/hgsc_software/cancer-analysis/resources/annotation-databases/cosmic/v71/CosmicCodingMuts.cnt3.vcf'
+# COSMIC compiled with cosmic_db.py, used instead of the vcf when it exists
+COSMIC_DB = COSMIC + '.cdb'
+VALSTATUS = '/hgsc_software/cancer-analysis/resources/dbsnp/hg19/146/dbSNP_b146_GRCh37p13.valstatus.db'
+
+##
+# in process filters by caller
+#
+# a filter takes an hgsc_vcf.Reader and returns the header of the filtered
+# records and an iterator of them, its records stream straight into the
+# sort.  Callers that are not here are filtered by the subprocesses of
+# VCF2VCF_FILTERS, or not at all.
+FILTERS = {
+        'muse': lambda reader: filter_muse.filter_vcf(reader, level = '5'),
+        'radia': filter_radia.filter_vcf,
+        }
+
+# callers filtered with vcf2vcf.pl --add-filter, and the name they are logged by
+VCF2VCF_FILTERS = {
+        'somaticsniper': 'SomaticSniper',
+        'varscans': 'VarScan SNP',
+        'varscani': 'VarScan INDEL',
+        }
+
+##
+# temporary path to write outputfpath to before it is moved in place
+#
+# it sits next to outputfpath and keeps its extension, every output has
+# its own so that stages running at the same time never share one.
+def tmppath(outputfpath):
+    dirname, name = os.path.split(outputfpath)
+    return os.path.join(dirname, '.tmp.' + name)
+
+##
+# file name without the directory and the .vcf or .vcf.gz extension
+def basename(fpath):
+    name = os.path.basename(fpath)
+    if name.endswith(hgsc_vcf.io.BGZF_EXTENSIONS):
+        name = os.path.splitext(name)[0]
+    return os.path.splitext(name)[0]
+
+##
+# filters and sorts the calls of caller in fpath
+#
+# with an in process filter from FILTERS the filtered records are sorted
+# as they are read, nothing is written before the sorted output.
+def filter_sort(fpath, caller, tmpdir):
+    transform = FILTERS.get(caller.lower())
+    if transform is None:
+        return sort(filter(fpath, caller, tmpdir), tmpdir)
+    outputfpath = os.path.join(tmpdir, basename(fpath) + '.filtered.sorted.vcf')
+    tmpfile = tmppath(outputfpath)
+    if os.path.isfile(outputfpath):
+        logger.info("Skipping filtering and sorting because %s exists", outputfpath)
+        return outputfpath
+    logger.info("Filtering and sorting %s -> %s", fpath, outputfpath)
+    reader = hgsc_vcf.Reader(hgsc_vcf.open_vcf(fpath), lazy = True)
+    try:
+        header, records = transform(reader)
+        vcf_sort.sort_records(vcf_sort.SeqDict(SEQDICT), header, records, tmpfile)
+    finally:
+        reader.fobj.close()
+    shutil.move(tmpfile, outputfpath)
+    return outputfpath
+
+##
+# filters fpath with vcf2vcf.pl when caller is one of VCF2VCF_FILTERS
 def filter(fpath, caller, tmpdir):
-    outputfpath = os.path.join(tmpdir, os.path.splitext(os.path.basename(fpath))[0] + '.filtered.vcf')
-    tmpfile = os.path.join(tmpdir, 'tmpfile.vcf')
+    name = VCF2VCF_FILTERS.get(caller.lower())
+    if name is None:
+        return fpath
+    outputfpath = os.path.join(tmpdir, basename(fpath) + '.filtered.vcf')
+    tmpfile = tmppath(outputfpath)
     if os.path.isfile(outputfpath):
         logger.info("Skipping filtering because %s exists", outputfpath)
         return outputfpath
-    if caller.lower() == 'muse':
-        logger.info("Applying MuSE filter to %s", fpath)
-        subprocess.check_call('python %(PACKAGE)s/filter_muse.py --level 5 %(input)s %(output)s' % {
-            'PACKAGE': PACKAGEDIR,
-            'input': fpath,
-            'output': tmpfile},
-            shell = True)
-        shutil.move(tmpfile, outputfpath)
-        return outputfpath
-    elif caller.lower() == 'radia':
-        logger.info("Applying RADIA filter to %s", fpath)
-        subprocess.check_call('python %(PACKAGE)s/filter_radia.py %(input)s %(output)s' % {
-            'PACKAGE': PACKAGEDIR,
-            'input': fpath,
-            'output': tmpfile},
-            shell = True)
-        shutil.move(tmpfile, outputfpath)
-        return outputfpath
-    elif caller.lower() == "somaticsniper":
-        nid, tid, nbar, tbar = getTNids(fpath)
-        logger.info("Applying SomaticSniper filter to %s", fpath)
-        subprocess.check_call('perl %(PACKAGE)s/vcf2maf/vcf2vcf.pl --add-filter --input-vcf %(input)s --output-vcf %(output)s --vcf-tumor-id %(tid)s --vcf-normal-id %(nid)s' %{
-            'PACKAGE': PACKAGEDIR,
-            'input': fpath,
-            'output': tmpfile,
-            'tid': tid,
-            'nid': nid},
-            shell = True)
-        shutil.move(tmpfile, outputfpath)
-        return outputfpath
-    elif caller.lower() == "varscans":
-        nid, tid, nbar, tbar = getTNids(fpath)
-        logger.info("Applying VarScan SNP filter to %s", fpath)
-        subprocess.check_call('perl %(PACKAGE)s/vcf2maf/vcf2vcf.pl --add-filter --input-vcf %(input)s --output-vcf %(output)s --vcf-tumor-id %(tid)s --vcf-normal-id %(nid)s' %{
-            'PACKAGE': PACKAGEDIR,
-            'input': fpath,
-            'output': tmpfile,
-            'tid': tid,
-            'nid': nid},
-            shell = True)
-        shutil.move(tmpfile, outputfpath)
-        return outputfpath
-    elif caller.lower() == "varscani":
-        nid, tid, nbar, tbar = getTNids(fpath)
-        logger.info("Applying VarScan INDEL filter to %s", fpath)
-        subprocess.check_call('perl %(PACKAGE)s/vcf2maf/vcf2vcf.pl --add-filter --input-vcf %(input)s --output-vcf %(output)s --vcf-tumor-id %(tid)s --vcf-normal-id %(nid)s' %{
-            'PACKAGE': PACKAGEDIR,
-            'input': fpath,
-            'output': tmpfile,
-            'tid': tid,
-            'nid': nid},
-            shell = True)
-        shutil.move(tmpfile, outputfpath)
-        return outputfpath
-    else:
-        return fpath
+    nid, tid, nbar, tbar = getTNids(fpath)
+    logger.info("Applying %s filter to %s", name, fpath)
+    subprocess.check_call('perl %(PACKAGE)s/vcf2maf/vcf2vcf.pl --add-filter --input-vcf %(input)s --output-vcf %(output)s --vcf-tumor-id %(tid)s --vcf-normal-id %(nid)s' %{
+        'PACKAGE': PACKAGEDIR,
+        'input': fpath,
+        'output': tmpfile,
+        'tid': tid,
+        'nid': nid},
+        shell = True)
+    shutil.move(tmpfile, outputfpath)
+    return outputfpath
 
 def sort(fpath, tmpdir):
-    outputfpath = os.path.join(tmpdir, os.path.splitext(os.path.basename(fpath))[0] + '.sorted.vcf')
-    tmpfile = os.path.join(tmpdir, 'tmpfile.vcf')
+    outputfpath = os.path.join(tmpdir, basename(fpath) + '.sorted.vcf')
+    tmpfile = tmppath(outputfpath)
     if os.path.isfile(outputfpath):
         logger.info("Skipping sort because %s exists", outputfpath)
         return outputfpath
     logger.info("Sorting %s -> %s", fpath, outputfpath)
-    subprocess.check_call('python %(PACKAGEDIR)s/vcf-sort.py %(seqdict)s %(input)s %(output)s' % {
-        'PACKAGEDIR': PACKAGEDIR,
-        'seqdict': '/hgsc_software/cancer-analysis/resources/references/human/hg19/hg19.dict',
-        'input': fpath,
-        'output': tmpfile},
-        shell = True)
+    # already sorted inputs are just copied, nearly sorted ones repaired in one pass
+    vcf_sort.sort_vcf(vcf_sort.SeqDict(SEQDICT), fpath, tmpfile)
     shutil.move(tmpfile, outputfpath)
     return outputfpath
 
@@ -135,8 +173,8 @@ def sort(fpath, tmpdir):
 def getTNids(fpath):
     sample_headers = []
     field_header = None
-    with open(fpath, 'r') as fi:
-        for line in fi.readlines():
+    with hgsc_vcf.open_vcf(fpath, 'r') as fi:
+        for line in fi:
             if line[0] != '#': 
                 break
             if '##SAMPLE' == line[:8]:
@@ -177,8 +215,8 @@ def getTNids(fpath):
         raise ValueError("Can't figure out the tumor and normal sample id's in %s" % samples)
 
 def v2v(fpath, tmpdir):
-    outputfpath = os.path.join(tmpdir, os.path.splitext(os.path.basename(fpath))[0] + '.v2v.vcf')
-    tmpfile = os.path.join(tmpdir, 'tmpfile.vcf')
+    outputfpath = os.path.join(tmpdir, basename(fpath) + '.v2v.vcf')
+    tmpfile = tmppath(outputfpath)
     if os.path.isfile(outputfpath):
         logger.info("Skipping vcf reduction because %s exists", outputfpath)
         return outputfpath
@@ -194,25 +232,21 @@ def v2v(fpath, tmpdir):
     shutil.move(tmpfile, outputfpath)
     return outputfpath
 
-def merge(outfile, mergefiles):
+def merge(outfile, mergefiles, processes = None):
     outputfpath = outfile
-    tmpfile = os.path.join(os.path.dirname(outputfpath), 'tmpfile.vcf')
+    tmpfile = tmppath(outputfpath)
     if os.path.isfile(outputfpath):
         logger.info("Skipping merge because %s exists", outputfpath)
         return outputfpath
     logger.info("Merging %s -> %s", mergefiles, outputfpath)
-    subprocess.check_call('python %(PACKAGEDIR)s/vcf-merge.py --keys %(keys)s --output %(output)s %(inputs)s' % {
-        'PACKAGEDIR': PACKAGEDIR,
-        'keys': ' '.join([c for c, f in mergefiles]),
-        'output': tmpfile,
-        'inputs': ' '.join([f for c, f in mergefiles])},
-        shell = True)
+    vcf_merge.merge_vcfs([f for c, f in mergefiles], [c for c, f in mergefiles], tmpfile,
+            vcf_merge.read_contig_ranks(SEQDICT), processes)
     shutil.move(tmpfile, outputfpath)
     return outputfpath
 
 def annotate(fpath, tmpdir):
-    outputfpath = os.path.join(tmpdir, os.path.splitext(os.path.basename(fpath))[0] + '.annotated.vcf')
-    tmpfile = os.path.join(tmpdir, 'tmpfile.vcf')
+    outputfpath = os.path.join(tmpdir, basename(fpath) + '.annotated.vcf')
+    tmpfile = tmppath(outputfpath)
 
     if os.path.isfile(outputfpath):
         logger.info("Skipping annotation because %s exists", outputfpath)
@@ -225,23 +259,20 @@ def annotate(fpath, tmpdir):
         logger.info("Processing vep annotation")
         subprocess.check_call('export PERL5LIB=/hgsc_software/cancer-analysis/code/vep-82:/users/covingto/perl5/lib/perl5:$PERL5LIB && export PATH=/hgsc_software/cancer-analysis/code/vep-82/htslib:$PATH && /hgsc_software/perl/perl-5.16.2/bin/perl /hgsc_software/cancer-analysis/code/vep-82/ensembl-tools-release-82/scripts/variant_effect_predictor/variant_effect_predictor.pl --dir /hgsc_software/cancer-analysis/code/vep-82/cache/human/grch37 --format vcf --everything -i %(input)s -o %(output)s --cache --vcf --force_overwrite --check_existing --allow_non_variant --buffer_size 100 --offline --fork 2' % {
             'input': fpath,
-            'output': tmpfile},
+            'output': tmppath(vepannotation)},
             shell = True)
-        shutil.move(tmpfile, vepannotation)
-    subprocess.check_call('export JYTHONPATH=/hgsc_software/cancer-analysis/halotron/illumina/illumina_v0.0.2/halotron/site-packages && export CLASSPATH=/hgsc_software/cancer-analysis/code/javalib/sqlite-jdbc-3.8.11.2/sqlite-jdbc-3.8.11.2.jar:/hgsc_software/cancer-analysis/code/picard-tools-1.129/picard.jar:/hgsc_software/cancer-analysis/code/picard-tools-1.129/picard-lib.jar:/hgsc_software/cancer-analysis/code/picard-tools-1.129/htsjdk-1.129.jar:/hgsc_software/cancer-analysis/code/krcgtk/krcgtk-0.01.jar:$CLASSPATH && /stornext/snfs2/can/code/jython/jython-2.7.0/bin/jython -J-Xmx15g /hgsc_software/cancer-analysis/halotron/illumina/illumina_v0.0.2/halotron/illumina/annotation/annotate_vcf_cosmic.py --reference %(reference)s %(cosmic)s %(input)s %(valstatus)s %(output)s' % {
-        'reference': '/hgsc_software/cancer-analysis/resources/references/human/hg19/hg19.fa',
-        'cosmic': '/hgsc_software/cancer-analysis/resources/annotation-databases/cosmic/v71/CosmicCodingMuts.cnt3.vcf',
-        'input': vepannotation,
-        'valstatus': '/hgsc_software/cancer-analysis/resources/dbsnp/hg19/146/dbSNP_b146_GRCh37p13.valstatus.db',
-        'output': tmpfile},
-        shell = True)
+        shutil.move(tmppath(vepannotation), vepannotation)
+    cosmic = COSMIC_DB if os.path.isfile(COSMIC_DB) else COSMIC
+    with open(vepannotation, 'r') as fi, open(tmpfile, 'w') as fo:
+        annotate_vcf_cosmic.annotate_vcf(fi, fo, cosmic, VALSTATUS, REFERENCE,
+                command = 'annotate_vcf_cosmic.py --reference %s %s %s %s %s' % (REFERENCE, cosmic, vepannotation, VALSTATUS, outputfpath))
     logger.info("Processing %s complete", outputfpath)
     shutil.move(tmpfile, outputfpath)
     return outputfpath
 
 def convert(opath, fpath):
     outputfpath = opath
-    tmpfile = os.path.join(os.path.dirname(outputfpath), 'tmpfile.maf')
+    tmpfile = tmppath(outputfpath)
     if os.path.isfile(outputfpath):
         logger.info("Skipping conversion because %s exists", outputfpath)
         return outputfpath
@@ -259,6 +290,88 @@ def convert(opath, fpath):
     shutil.move(tmpfile, outputfpath)
     return outputfpath
 
+##
+# CPUs the job was given, cpus when set, else the NSLOTS of the grid engine
+#
+# without either the allocation is not known and the job runs on 1 CPU,
+# the CPU count of the node would overcommit a shared node.
+def default_cpus(cpus = None):
+    if cpus:
+        return cpus
+    try:
+        return int(os.environ['NSLOTS'])
+    except (KeyError, ValueError):
+        return 1
+
+##
+# filters, sorts and reduces (v2v) the calls of caller in fpath, returns (caller, v2v path)
+def prepare(caller, fpath, tmpdir):
+    return caller, v2v(filter_sort(fpath, caller, tmpdir), tmpdir)
+
+##
+# runs prepare for each (caller, path) of calls, returns the results in the order of calls
+#
+# the callers are independent until the merge, so their chains run at the
+# same time on a pool of up to cpus processes.  Without multiprocessing
+# (jython) or with one CPU they run one after the other.
+def prepare_all(calls, tmpdir, cpus):
+    pool = mergesort.make_pool(min(cpus, len(calls)))
+    if pool is None:
+        return [prepare(c, f, tmpdir) for c, f in calls]
+    try:
+        results = [pool.apply_async(mergesort.pool_call, (prepare, c, f, tmpdir)) for c, f in calls]
+        pool.close()
+        return [r.get() for r in results]
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# stands in for prepare in test(), the callers finish in reverse order and
+# the fail caller raises what a failed vcf2vcf.pl raises
+def _test_prepare(caller, fpath, tmpdir):
+    if caller == 'fail':
+        raise subprocess.CalledProcessError(1, 'vcf2vcf.pl')
+    time.sleep(0.02 * (10 - int(caller[1:])))
+    return caller, tmppath(os.path.join(tmpdir, fpath))
+
+def test():
+    print "starting test"
+    global prepare
+    assert tmppath('/a/b/c.vcf') == '/a/b/.tmp.c.vcf' and tmppath('c.vcf.gz') == '.tmp.c.vcf.gz'
+    nslots = os.environ.pop('NSLOTS', None)
+    try:
+        assert default_cpus() == 1 and default_cpus(3) == 3
+        os.environ['NSLOTS'] = '4'
+        assert default_cpus() == 4 and default_cpus(2) == 2
+    finally:
+        os.environ.pop('NSLOTS', None)
+        if nslots is not None:
+            os.environ['NSLOTS'] = nslots
+    real_prepare = prepare
+    prepare = _test_prepare
+    try:
+        calls = [('c%d' % i, 'f%d.vcf' % i) for i in range(6)]
+        expected = [(c, os.path.join('t', '.tmp.' + f)) for c, f in calls]
+        for cpus in (1, 3, 8):
+            assert prepare_all(calls, 't', cpus) == expected, cpus
+        # a failure in the pool comes back instead of hanging it
+        calls.insert(2, ('fail', 'f.vcf'))
+        try:
+            prepare_all(calls, 't', 1)
+            assert False
+        except subprocess.CalledProcessError:
+            pass
+        try:
+            prepare_all(calls, 't', 3)
+            assert False
+        except RuntimeError as e:
+            assert 'CalledProcessError' in str(e)
+    finally:
+        prepare = real_prepare
+    print "Success"
+
 def main(args):
     try:
         if len(args.vcfs) != len(args.callers):
@@ -271,14 +384,12 @@ def main(args):
 
         # generate the caller tuples
         calls = zip(args.callers, args.vcfs)
-        # filter the vcf files
-        filters = [(c, filter(f, c, args.tmpdir)) for c, f in calls]
-        # sort the vcf files
-        sorts = [(c, sort(f, args.tmpdir)) for c, f in filters]
-        # v2v
-        v2vs = [(c, v2v(f, args.tmpdir)) for c, f in sorts]
+        cpus = default_cpus(args.cpus)
+        logger.info("Running on %s CPUs", cpus)
+        # filter, sort and v2v the vcf files of the callers at the same time
+        v2vs = prepare_all(calls, args.tmpdir, cpus)
         # merge
-        merged = merge(os.path.join(args.tmpdir, 'merged.vcf'), v2vs)
+        merged = merge(os.path.join(args.tmpdir, 'merged.vcf'), v2vs, cpus)
         # annotate
         annotated = annotate(merged, args.tmpdir)
         # vcf2maf
@@ -298,6 +409,7 @@ if __name__ == '__main__':
     parser.add_argument('--vcfs', type = str, nargs = '+', help = 'vcf file path(s)')
     parser.add_argument('--callers', type = str, nargs = '+', help = 'caller keys, same len as vcfs and in same order')
     parser.add_argument('--tmpdir', type = str, help = 'location of tmp directory for processing')
+    parser.add_argument('--cpus', type = int, help = 'CPUs to run on, defaults to NSLOTS or 1')
     parser.add_argument('OUTPUTMAF', type = str, help = 'output file path for the merged MAF file')
 
     args = parser.parse_args()
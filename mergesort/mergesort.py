@@ -4,8 +4,101 @@ Created on May 6, 2016
 @author: covingto
 '''
 
-import json, tempfile
+import sys, tempfile, traceback
 import shutil, os.path
+import heapq
+import collections
+import struct, zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+##
+# run files
+#
+# sorted chunks are spilled to run files of length prefixed records, each
+# record is the pickled key followed by the pickled value.  Keys are read
+# back on their own so the merge only unpickles a value when it is handed
+# out.  Records are grouped into blocks that are zlib compressed at level 1
+# when compress is set.
+RUN_MAGIC = 'MSRUN1'
+RUN_BLOCK_SIZE = 1 << 18
+# memory for the blocks of the runs open in one merge
+MERGE_MEMORY = 1 << 28
+# with a memory budget the first SAMPLE_ALL records and every SAMPLE_EVERY
+# one after that are measured to estimate the size of a chunk
+SAMPLE_ALL = 1000
+SAMPLE_EVERY = 32
+_BLOCK = struct.Struct('<I')
+_RECORD = struct.Struct('<II')
+
+def _dumps(obj):
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+class RunWriter(object):
+    def __init__(self, fpath, compress = True):
+        self.fpath = fpath
+        self.compress = compress
+        self.fobj = open(fpath, 'wb')
+        self.fobj.write(RUN_MAGIC + ('z' if compress else '-'))
+        self._buffer = []
+        self._size = 0
+
+    def write(self, key, value):
+        self.write_raw(_dumps(key), _dumps(value))
+
+    ##
+    # writes an already pickled key and value
+    def write_raw(self, rawkey, rawvalue):
+        self._buffer.append(_RECORD.pack(len(rawkey), len(rawvalue)))
+        self._buffer.append(rawkey)
+        self._buffer.append(rawvalue)
+        self._size += _RECORD.size + len(rawkey) + len(rawvalue)
+        if self._size >= RUN_BLOCK_SIZE:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        if self.compress:
+            data = zlib.compress(data, 1)
+        self.fobj.write(_BLOCK.pack(len(data)))
+        self.fobj.write(data)
+        self._buffer = []
+        self._size = 0
+
+    def close(self):
+        self._flush_block()
+        self.fobj.close()
+
+##
+# yields (key, pickled key, pickled value) for the records of a run file
+def read_run(fpath):
+    with open(fpath, 'rb') as fi:
+        head = fi.read(len(RUN_MAGIC) + 1)
+        if head[:len(RUN_MAGIC)] != RUN_MAGIC:
+            raise IOError("%s is not a mergesort run file" % fpath)
+        compressed = head[-1] == 'z'
+        while True:
+            size = fi.read(_BLOCK.size)
+            if not size:
+                break
+            data = fi.read(_BLOCK.unpack(size)[0])
+            if compressed:
+                data = zlib.decompress(data)
+            offset = 0
+            while offset < len(data):
+                klen, vlen = _RECORD.unpack_from(data, offset)
+                offset += _RECORD.size
+                rawkey = data[offset:offset + klen]
+                offset += klen
+                yield pickle.loads(rawkey), rawkey, data[offset:offset + vlen]
+                offset += vlen
+
+def _runkey(x):
+    return x[0]
 
 class PeekWrapper(object):
     def __init__(self, myiter):
@@ -42,60 +135,276 @@ def chunk(myiter, size):
             batch = []
     yield batch
 
+##
+# sys.getsizeof(obj), or default where that is missing
+def _getsizeof(obj, default):
+    try:
+        return sys.getsizeof(obj)
+    except (AttributeError, TypeError): # jython has no getsizeof
+        return default
+
+##
+# approximate memory used by obj and the containers and strings within it
+def sizeof(obj):
+    size = _getsizeof(obj, None)
+    if size is None:
+        return len(_dumps(obj)) * 4
+    if isinstance(obj, collections.Mapping):
+        size += sum([sizeof(k) + sizeof(v) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum([sizeof(i) for i in obj])
+    return size
+
+##
+# yields (pairs, last) chunks of the (key, record) pairs of myiter
+#
+# a chunk holds maxrecords records, or with maxbytes set as many as are
+# estimated to fit in maxbytes from the mean size of the sampled pairs so
+# far.  last is True for the final chunk.
+def _key_chunks(myiter, keyfun, maxrecords, maxbytes):
+    batch = []
+    full = False
+    nsampled = 0
+    sampled = 0
+    for i in myiter:
+        if full:
+            yield batch, False
+            batch = []
+        pair = (keyfun(i), i)
+        batch.append(pair)
+        if maxbytes is None:
+            full = len(batch) >= maxrecords
+        else:
+            if nsampled < SAMPLE_ALL or len(batch) % SAMPLE_EVERY == 0:
+                nsampled += 1
+                sampled += sizeof(pair)
+            # the list itself, a pointer per pair where getsizeof is missing
+            full = sampled * len(batch) // nsampled + _getsizeof(batch, 8 * len(batch)) >= maxbytes
+    yield batch, True
+
+##
+# merges the sorted iterables in initers by keyfun
+#
+# the head of each input sits in a heap as (key, input number, record) so
+# every record has its key computed once and takes O(log k) to place.
+# Records with equal keys come out in the order of initers.
 def mergepeek(initers, keyfun):
-    inpeeks = [PeekWrapper((r for r in i if r != '')) for i in initers]
-    inpeeks = sorted(inpeeks, key = lambda x: keyfun(x.peek()))
-    nsorts = 1
-    while len(inpeeks) > 1:
-        if inpeeks[0].peek() is None:
-            inpeeks = sorted(inpeeks[1:], key = lambda x: keyfun(x.peek()))
-            continue # iterate again
-        if keyfun(inpeeks[0].peek()) > keyfun(inpeeks[1].peek()):
-            print 'mergepeek sorting number %d' % nsorts
-            nsorts += 1
-            inpeeks = sorted(inpeeks, key = lambda x: keyfun(x.peek()))
-        yield inpeeks[0].take()
-    lastpeek = inpeeks[0]
-    while lastpeek.peek() is not None:
-        yield lastpeek.take()
+    heap = []
+    for n, i in enumerate(initers):
+        i = (r for r in i if r != '')
+        for r in i:
+            heap.append((keyfun(r), n, r, i))
+            break
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        key, n, r, i = heap[0]
+        for nr in i:
+            heapq.heapreplace(heap, (keyfun(nr), n, nr, i))
+            break
+        else:
+            heapq.heappop(heap)
+        yield r
+    if heap:
+        key, n, r, i = heap[0]
+        yield r
+        for r in i:
+            yield r
     
         
-def mergesort(myiter, keyfun, maxrecords = 100000, maxpaths = 10):
-    tmpdir = tempfile.mkdtemp('.mergesort', dir=os.path.abspath('.'))
-    fnum = 0
-    fpaths = []
-    for c in chunk(myiter, maxrecords):
-        #print "chunk returned: %s" % str(c)
-        _opath = os.path.join(tmpdir, 'tmp-%d.jsonl' % fnum)
-        fnum += 1
-        csort = sorted([{'key': keyfun(cc), 'value': cc} for cc in c], key = lambda x: x['key'])
-        with open(_opath, 'w') as fo:
-            fo.write('\n'.join( [json.dumps(cc) for cc in csort] ))
-        fpaths.append(_opath)
-        if len(fpaths) > maxpaths:
-            # now read back in and make one file ...
-            _opath = os.path.join(tmpdir, 'tmp-%d.jsonl' % fnum)
-            fnum += 1
-            with open(_opath, 'w') as fo:
-                fhandles = [open(p, 'r') for p in fpaths]
-                for r in mergepeek(fhandles, lambda x: json.loads(x)['key']):
-                    fo.write(r.strip() + '\n')
-                # clean up the open file handles
-                for h in fhandles:
-                    h.close()
-                for p in fpaths:
-                    os.remove(p) # we won't use these again
-            fpaths = [_opath]
-    fhandles = [open(p, 'r') for p in fpaths]
-    for r in mergepeek(fhandles, lambda x: json.loads(x)['key']):
-        yield json.loads(r)['value']
-    for h in fhandles:
-        h.close()
-    shutil.rmtree(tmpdir, False)
+##
+# sorts the (key, value) pairs of a chunk and writes them to the run file opath
+#
+# this runs in the worker processes when mergesort is given processes
+def _spill_run(pairs, opath, compress):
+    pairs.sort(key = _runkey)
+    writer = RunWriter(opath, compress)
+    for k, v in pairs:
+        writer.write(k, v)
+    writer.close()
+    return opath
+
+##
+# multiprocessing.Pool of processes, None for fewer than 2 or without multiprocessing
+#
+# callers run the work in this process when there is no pool.
+def make_pool(processes):
+    if processes is None or processes < 2:
+        return None
+    try:
+        import multiprocessing
+        return multiprocessing.Pool(processes)
+    except (ImportError, NotImplementedError, OSError): # jython has no multiprocessing
+        return None
+
+##
+# calls fn(*args), for pool.apply_async(pool_call, (fn,) + args)
+#
+# failures come back as a RuntimeError holding the traceback, python 2.7
+# can not unpickle some exceptions (the CalledProcessError of a failed
+# subprocess for one) and the pool hangs on those instead of raising them.
+def pool_call(fn, *args):
+    try:
+        return fn(*args)
+    except Exception:
+        raise RuntimeError(traceback.format_exc())
+
+##
+# number of runs to merge at once
+#
+# bounded by the open file limit (less some for everything else) and by
+# the memory that the block buffers of the open runs may use.
+def default_fanin(memory = MERGE_MEMORY, reserve = 64):
+    fds = 1024
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            fds = soft
+    except (ImportError, ValueError): # no resource module under jython
+        pass
+    # a compressed and a decompressed block per open run
+    return max(2, min(fds - reserve, memory // (2 * RUN_BLOCK_SIZE)))
+
+##
+# merge tree over the run files
+#
+# runs are added as they are made and kept in levels, when a level holds
+# fanin runs they are merged into one run of the next level.  Every record
+# is rewritten once per level, O(log_fanin(runs)) times in all, and no more
+# than fanin runs are ever open at once.  The runs of higher levels hold
+# older records so listing the levels from the top keeps the runs in input
+# order, which keeps the merge stable.
+class _RunTree(object):
+    def __init__(self, tmpdir, fanin, compress):
+        self.tmpdir = tmpdir
+        self.fanin = fanin
+        self.compress = compress
+        self.levels = []
+        self.fnum = 0
+
+    def path(self):
+        _opath = os.path.join(self.tmpdir, 'tmp-%d.run' % self.fnum)
+        self.fnum += 1
+        return _opath
+
+    def add(self, fpath, level = 0):
+        while len(self.levels) <= level:
+            self.levels.append([])
+        runs = self.levels[level]
+        runs.append(fpath)
+        if len(runs) >= self.fanin:
+            self.levels[level] = []
+            self.add(self._merge(runs), level + 1)
+
+    def _merge(self, fpaths):
+        _opath = self.path()
+        writer = RunWriter(_opath, self.compress)
+        for k, rawkey, rawvalue in mergepeek([read_run(p) for p in fpaths], _runkey):
+            writer.write_raw(rawkey, rawvalue)
+        writer.close()
+        for p in fpaths:
+            os.remove(p) # we won't use these again
+        return _opath
+
+    ##
+    # merges the newest runs until at most fanin are left and returns those in input order
+    def finish(self):
+        runs = [p for level in reversed(self.levels) for p in level]
+        while len(runs) > self.fanin:
+            n = min(self.fanin, len(runs) - self.fanin + 1)
+            runs = runs[:-n] + [self._merge(runs[-n:])]
+        return runs
+
+##
+# sorts the records of myiter by keyfun, spilling sorted chunks to disk
+#
+# the run files go to a new directory in tmpdir, the current directory
+# when it is None as it was before tmpdir could be given (/tmp is often
+# small on the cluster nodes).  They are merged maxpaths at a time, by
+# default as many as default_fanin() allows.
+#
+# chunks are maxrecords records, or with maxbytes set they are sized to
+# keep the records and keys held in memory under maxbytes, measured from
+# the records themselves.  When the whole input fits in one chunk it is
+# sorted in memory and nothing is written to disk.
+#
+# with processes > 1 the chunks are sorted and spilled by a pool of that
+# many processes while this process keeps reading the input and computing
+# keys (so keyfun does not need to be picklable, the records and keys do).
+# At most processes chunks are in flight at a time to bound the memory,
+# maxbytes is shared between those and the chunk being read.
+def mergesort(myiter, keyfun, maxrecords = 100000, maxpaths = None, compress = True, processes = None, tmpdir = None, maxbytes = None):
+    chunk_bytes = maxbytes
+    if maxbytes is not None and processes is not None and processes > 1:
+        chunk_bytes = maxbytes // (processes + 1)
+    chunks = _key_chunks(myiter, keyfun, maxrecords, chunk_bytes)
+    pairs, last = chunks.next()
+    if last:
+        pairs.sort(key = _runkey)
+        for k, v in pairs:
+            yield v
+        return
+    # handed over in a list so that this frame does not keep the chunk alive
+    first = [pairs]
+    pairs = None
+    tmpdir = tempfile.mkdtemp('.mergesort', dir = os.path.abspath(tmpdir or '.'))
+    try:
+        tree = _RunTree(tmpdir, maxpaths or default_fanin(maxbytes or MERGE_MEMORY), compress)
+        _make_runs(first, chunks, tree, compress, processes)
+        fpaths = tree.finish()
+        for k, rawkey, rawvalue in mergepeek([read_run(p) for p in fpaths], _runkey):
+            yield pickle.loads(rawvalue)
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def _make_runs(first, chunks, tree, compress, processes):
+    pool = make_pool(processes)
+    pending = collections.deque()
+    pairs, last = first.pop(), False
+    try:
+        while True:
+            if pool is None:
+                tree.add(_spill_run(pairs, tree.path(), compress))
+            else:
+                pending.append(pool.apply_async(pool_call, (_spill_run, pairs, tree.path(), compress)))
+                while len(pending) > processes:
+                    tree.add(pending.popleft().get())
+            pairs = None
+            if last:
+                break
+            pairs, last = chunks.next()
+        while pending:
+            tree.add(pending.popleft().get())
+    finally:
+        if pool is not None:
+            if pending: # failed part way
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
 
 def test():
     print "starting test"
     r = [v for v in mergesort(range(100), lambda x: x, maxrecords=10, maxpaths = 5)]
     assert r == [v for v in range(100)]
+    r = [v for v in mergesort(reversed(range(100)), lambda x: -x, maxrecords=10, maxpaths = 5, compress = False)]
+    assert r == [v for v in reversed(range(100))]
+    r = [v for v in mergesort(range(100), lambda x: x % 7, maxrecords=10, maxpaths = 5, processes = 2)]
+    assert r == sorted(range(100), key = lambda x: x % 7)
+    r = [v for v in mergesort(range(1000), lambda x: x % 13, maxrecords=3, maxpaths = 3)]
+    assert r == sorted(range(1000), key = lambda x: x % 13)
+    r = [v for v in mergesort(range(1000), lambda x: -x, maxbytes = 1 << 12)]
+    assert r == [v for v in reversed(range(1000))]
+    r = [v for v in mergesort(range(1000), lambda x: -x, maxbytes = 1 << 20)]
+    assert r == [v for v in reversed(range(1000))]
+    # the pool gives the same, stable, order as sorting in this process
+    data = [(i * 7919) % 1009 for i in range(5000)]
+    serial = [v for v in mergesort(data, lambda x: x % 101, maxbytes = 1 << 12)]
+    assert serial == sorted(data, key = lambda x: x % 101)
+    for processes in (2, 3):
+        r = [v for v in mergesort(data, lambda x: x % 101, maxbytes = 1 << 12, processes = processes)]
+        assert r == serial, processes
+        r = [v for v in mergesort(data, lambda x: x % 101, maxrecords = 97, maxpaths = 4, processes = processes, compress = False)]
+        assert r == serial, processes
     print "Success"
 
@@ -225,6 +225,7 @@ def main(args):
         for b_record in hgsc_vcf.select_allele(record, lambda x: [hgsc_vcf.best_alt_index(x)]):
             b_record['INFO']['VTE'] = [vartype_exclusivity(sample_model_map, b_record, _sample_affinity_f) + _record_f(b_record)]
             writer.write_record(b_record)
+    writer.close()
 
 
 ##
@@ -1,17 +1,17 @@
 
 import os, os.path, sys
 import glob
+import heapq
+import tempfile, shutil
 import hgsc_vcf
+from mergesort import mergesort
 import logging
 from collections import *
 
-logger = logging.getLogger()
+# merge.py loads this file to merge in process, the handler is only set up when run as a script
+logger = logging.getLogger('vcf-merge')
 logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+logger.addHandler(logging.NullHandler())
 
 ##
 # Goal; to merge multiple vcf files for a subject.
@@ -22,26 +22,75 @@ logger.addHandler(ch)
 #   2. routines to handle the merger of the events (subroutine of the class or independent)
 #   3. writer (hgsc_vcf.Writer class)
 #   4. something to merge the headers?
+#
+# merge_records is the library entry point, it merges any record iterables
+# (hgsc_vcf.Readers or the output of other stages) and yields the merged
+# records so the merge can be chained with the stages around it in one
+# process.  merge_vcfs does the same for files, with processes > 1 it
+# merges every contig on its own in a pool of processes.
+
+# sort keys are contig rank * POSITION_SPAN + POS
+POSITION_SPAN = 1000000000
+# records in a merge batch before it is cut
+MAX_CLUSTER = 1000
+
+##
+# {contig: rank} in the order of the @SQ lines of a sequence dict
+def read_contig_ranks(fpath):
+    ranks = {}
+    with open(fpath, 'r') as fi:
+        for line in fi:
+            if not line.startswith('@SQ'):
+                continue
+            for field in line.rstrip('\r\n').split('\t')[1:]:
+                if field.startswith('SN:'):
+                    ranks[field[3:]] = len(ranks)
+                    break
+    return ranks
+
+##
+# contig rank without a sequence dict: numbered contigs, then X, Y and M/MT
+def default_rank(chrom):
+    if chrom == 'X':
+        return 30
+    elif chrom == 'Y':
+        return 40
+    elif chrom in ('M', 'MT'):
+        return 50
+    return int(chrom)
+
+##
+# rank of chrom in ranks, or the default one without ranks
+def contig_rank(chrom, ranks = None):
+    if ranks is None:
+        return default_rank(chrom)
+    try:
+        return ranks[chrom]
+    except KeyError:
+        raise ValueError("%s is not in the sequence dictionary" % chrom)
+
+##
+# reference bases covered by record, from REF or from END for symbolic alleles
+def record_length(record):
+    length = max(len(record['REF']), 1)
+    if any([a.startswith('<') for a in record['ALT']]):
+        end = record['INFO'].get('END')
+        if end:
+            try:
+                length = max(length, int(end[0]) - record['POS'] + 1)
+            except ValueError:
+                pass
+    return length
 
 class MetaRecord(object):
-    def __init__(self, caller, record):
+    def __init__(self, caller, record, key):
         self.caller = caller
         self.record = record
-    
-    def _seq_pos(self, record):
-        if record['CHROM'] == 'X':
-            return 30 * 1000000000 + record['POS']
-        elif record['CHROM'] == 'Y':
-            return 40 * 1000000000 + record['POS']
-        elif record['CHROM'] in ('M', 'MT'):
-            return 50 * 1000000000 + record['POS']
-        else:
-            return int(record['CHROM']) * 1000000000 + record['POS']
+        self.key = key # precomputed from the contig rank and POS
+        self.end = key + record_length(record) - 1 # key of the last reference base
 
     def __cmp__(self, other):
-        si = self._seq_pos(self.record)
-        oi = self._seq_pos(other.record)
-        return si - oi
+        return cmp(self.key, other.key)
         '''
         block commented out because we don't actually care that the alts aren't the same???
         if si != oi:
@@ -52,17 +101,25 @@ class MetaRecord(object):
     def __repr__(self):
         return "<record chr=%s, pos=%s, alt=%s>" % (self.record['CHROM'], self.record['POS'], self.record['ALT'])
 
+##
+# the records of one caller, filtered to PASS calls with a reference normal
+#
+# records is any iterator of records in contig and POS order, header is
+# the VCF header they came with (for the sample mapping) and caller names
+# them in the merge.
 class MetaReader(object):
-    def __init__(self, fobj):
-        self.reader = hgsc_vcf.Reader(fobj)
-        self.caller = fobj.name
+    def __init__(self, records, header, caller, ranks = None):
+        self.records = iter(records)
+        self.header = header
+        self.caller = caller
+        self.ranks = ranks
         # get the normal and primary sample ids
-        sampleMapping = {l.fields.get('ID'):l.fields.get('SampleTCGABarcode') for l in self.reader.header.get_headers('SAMPLE')}
+        sampleMapping = {l.fields.get('ID'):l.fields.get('SampleTCGABarcode') for l in self.header.get_headers('SAMPLE')}
         if 'PRIMARY' not in sampleMapping and 'METASTATIC' in sampleMapping:
             sampleMapping['PRIMARY'] = sampleMapping['METASTATIC']
         elif 'PRIMARY' not in sampleMapping and 'RECURRANCE' in sampleMapping:
             sampleMapping['PRIMARY'] = sampleMapping['RECURRANCE']
-        logger.info("Sample mapping for %s: %s", fobj.name, sampleMapping)
+        logger.info("Sample mapping for %s: %s", caller, sampleMapping)
         self.normal = sampleMapping['NORMAL']
         self.primary = sampleMapping['PRIMARY']
         self._next = None
@@ -72,6 +129,9 @@ class MetaReader(object):
 
     def peek(self):
         return self._next
+
+    def _key(self, record):
+        return contig_rank(record['CHROM'], self.ranks) * POSITION_SPAN + record['POS']
     
     def take(self):
         old = self._next
@@ -79,12 +139,13 @@ class MetaReader(object):
         new = None
         while True:
             try:
-                n = self.reader.next()
+                n = self.records.next()
                 if 'GL' in n['CHROM']:
+                    # the GL contigs sort last, nothing after them is merged
                     logger.info("GL in chrom %s", n['CHROM'])
                     logger.info("Closing %s", self.caller)
-                    self.reader.fobj.close()
                     new = None
+                    break
                 if 'NORMAL' not in n['SAMPLES']:
                     n['SAMPLES']['NORMAL'] = n['SAMPLES'][self.normal]
                 if 'PRIMARY' not in n['SAMPLES']: 
@@ -105,13 +166,12 @@ class MetaReader(object):
             except StopIteration: # swallow the error and just set to None
                 logger.info("Stopped iteration")
                 logger.info("Closing %s", self.caller)
-                self.reader.fobj.close()
                 new = None
                 break
         if new is None:
             self._next = None
         else:
-            self._next = MetaRecord(self.caller, new)
+            self._next = MetaRecord(self.caller, new, self._key(new))
         return old
 
     def __repr__(self):
@@ -122,87 +182,88 @@ class MetaReader(object):
 
     
 
+##
+# the records of several MetaReaders merged into batches of nearby records
+#
+# a batch is a cluster of records that overlap or lie within buffer bases
+# of each other.  Clusters are cut at max_cluster records (between two
+# positions, never within one) so that dense regions can not build up
+# unbounded batches, stats counts the records and clusters.
 class MultiVCFReader(object):
-    def __init__(self, infiles, outfile, keys):
-        self.buffer = 10
-        self.infiles = {f:MetaReader(open(f, 'r')) for f in infiles}
-        self.outfile = outfile
-        self.outwriter = hgsc_vcf.Writer(open(self.outfile, 'w'), self.generate_header())
-        # get the normal and primary sample ids
-        sampleMapping = {l.fields.get('ID'):l.fields.get('SampleTCGABarcode') for l in self.infiles.values()[0].reader.header.get_headers('SAMPLE')}
-        if 'PRIMARY' not in sampleMapping and 'METASTATIC' in sampleMapping:
-            sampleMapping['PRIMARY'] = sampleMapping['METASTATIC']
-        elif 'PRIMARY' not in sampleMapping and 'RECURRANCE' in sampleMapping:
-            sampleMapping['PRIMARY'] = sampleMapping['RECURRANCE']
-        self.normal = sampleMapping['NORMAL']
-        self.primary = sampleMapping['PRIMARY']
-        self.keymap = dict(zip(infiles, keys))
+    def __init__(self, readers, buffer = 10, max_cluster = MAX_CLUSTER):
+        self.buffer = buffer
+        self.max_cluster = max_cluster
+        self.readers = list(readers)
+        self.stats = Counter()
 
-    # lets make this a generator so that we can keep up with the sorting
-    # very likely that once something is in sorted order we can keep it that way
+    ##
+    # yields the MetaRecords of all readers in order of their keys
+    #
+    # the readers sit in a heap on (key of their next record, reader number),
+    # records with the same key come from one reader before the next.
     def get_next(self):
-        while True:
-            nextsort = sorted([mr for mr in self.infiles.values() if mr.peek() is not None])
-            if len(nextsort) < 1:
-                raise StopIteration() # we can break here
-            _raises = True
-            for r in self._get_sorted_next(nextsort):
-                _raises = False
-                yield r
-            if _raises:
-                logger.info("Sorted %s", nextsort)
-                if len(nextsort) > 1:
-                    logger.info("n0 <= n1: %s", nextsort[0] <= nextsort[1])
-                    logger.info("nextsort[0]._next: %s", nextsort[0]._next)
-                raise ValueError("Entered sorted but did not yield")
-    # helper generator 
-    def _get_sorted_next(self, nextsort):
-        if len(nextsort) < 2:
-            n0 = nextsort[0]
-            while n0.peek() is not None:
-                yield n0.take()
-        else:
-            n0 = nextsort[0]
-            n1 = nextsort[1]
-            while n0.peek() is not None and n0 <= n1:
-                yield n0.take()
-            if n0.peek() is None:
-                logger.info("Reached the end of %s", n0.caller)
-
+        heap = [(mr.peek().key, i, mr) for i, mr in enumerate(self.readers) if mr.peek() is not None]
+        heapq.heapify(heap)
+        while heap:
+            key, i, mr = heap[0]
+            r = mr.take()
+            if mr.peek() is None:
+                logger.info("Reached the end of %s", mr.caller)
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (mr.peek().key, i, mr))
+            yield r
 
     def generate_header(self):
-        newHeader = hgsc_vcf.VCFHeader()
-        newHeader.samples = ['NORMAL', 'PRIMARY'] # deterministic sample names now
-        for infile in self.infiles.values():
-            newHeader.headers += infile.reader.header.headers # append all of the headers together, who cares, we can sort out later
-        newHeader.add_header('##COMMAND=<ID=vcf-merge>')
-        return newHeader
+        return merge_headers([r.header for r in self.readers])
 
     ##
     # yields batches of MetaRecord's
+    #
+    # works on the keys, the reach of a cluster is the largest end key of
+    # its records plus buffer and a record past it starts a new cluster.
+    # Keys of different contigs are further apart than any reach, so
+    # clusters never span contigs.
     def chunk(self):
+        stats = self.stats
         batch = []
-        cpos = 0
+        reach = -1
         for r in self.get_next(): # run through the generator
-            if len(batch) < 1:
-                batch.append(r)
-                cpos = r.record['POS'] + max(len(r.record['REF']), max([len(a) for a in r.record['ALT']])) - 1 + self.buffer
-            elif r.record['CHROM'] != batch[0].record['CHROM']:
-                yield batch
+            if r.key > reach or (len(batch) >= self.max_cluster and r.key != batch[-1].key):
+                if batch:
+                    if r.key <= reach:
+                        stats['cut'] += 1
+                    stats['clusters'] += 1
+                    stats['largest'] = max(stats['largest'], len(batch))
+                    yield batch
                 batch = [r]
-            elif r.record['POS'] > (batch[-1].record['POS'] + self.buffer):
-                yield batch
-                batch = [r]
-                cpos = r.record['POS'] + max(len(r.record['REF']), max([len(a) for a in r.record['ALT']])) - 1 + self.buffer
+                reach = r.end + self.buffer
             else:
                 batch.append(r)
-                cpos = max(cpos, r.record['POS'] + max(len(r.record['REF']), max([len(a) for a in r.record['ALT']])) - 1 + self.buffer)
-        yield batch # yield the last batch
+                reach = max(reach, r.end + self.buffer)
+            stats['records'] += 1
+        if batch:
+            stats['clusters'] += 1
+            stats['largest'] = max(stats['largest'], len(batch))
+            yield batch # yield the last batch
+        logger.info("Merged %d records in %d clusters, the largest of %d, %d cut at %d records",
+                stats['records'], stats['clusters'], stats['largest'], stats['cut'], self.max_cluster)
 
     # make this an iterable
     def __iter__(self):
         return self.chunk()
 
+##
+# the header of the merged records from the headers of the inputs
+def merge_headers(headers):
+    newHeader = hgsc_vcf.VCFHeader()
+    newHeader.samples = ['NORMAL', 'PRIMARY'] # deterministic sample names now
+    for header in headers:
+        newHeader.headers += header.headers # append all of the headers together, who cares, we can sort out later
+    newHeader.add_header('##COMMAND=<ID=vcf-merge>')
+    newHeader.add_header('##INFO=<ID=CENTERS,Number=1,Type=String,Description="Center files that made the call">')
+    return newHeader
+
 def parseInfo(merge, type):
     sdp = sad = 0.0
     for m in merge:
@@ -238,11 +299,24 @@ def contains_pindel(batch):
             return True
     return False
 
+##
+# (CHROM, POS, REF, ALT) of record with the alleles trimmed of shared bases
+def allele_key(record):
+    ref, alt, pos = hgsc_vcf._simplify_allele(record['REF'], list(record['ALT']), record['POS'])
+    return record['CHROM'], pos, ref, tuple(alt)
+
+##
+# resolves a batch into merged records
+#
+# a batch with a pindel call resolves to that call.  Otherwise the records
+# are grouped by allele_key in one pass and the groups are merged, in order
+# of the key of their first record (then their allele).  Records keep their
+# batch order within a group.
 def resolve_records(batch, callermap):
     if len(batch) == 1:
         yield resolve_merge(batch, callermap)
     else:
-        logger.info("Processing batch size: %s", len(batch))
+        logger.debug("Processing batch size: %s", len(batch))
         if contains_pindel(batch):
             # it's a pindel call, merge all and yield the pindel call
             pc = [r for r in batch if 'pindel' in r.caller][0] # this must be true, but there might be more than one???
@@ -255,46 +329,227 @@ def resolve_records(batch, callermap):
             logger.info("Merged pindel call with %s", callset)
             yield resolve_merge([pc], callermap)[0], '|'.join(callset)
         else:
-            merge = []
+            groups = {}
             for r in batch:
-                if len(merge) < 1:
-                    merge.append(r)
+                key = allele_key(r.record)
+                if key in groups:
+                    groups[key].append(r)
                 else:
-                    p = merge[0]
-                    if r != p: # takes "advantage" of the cmp method, convenient for this purpose but otherwise dangerous
-                        logger.info("Splitting batch because not the same")
-                        logger.info(r)
-                        logger.info(p)
-                        logger.info("Yielding batch of %s", len(merge))
-                        yield resolve_merge(merge, callermap)
-                        merge = [r]
-                    else:
-                        merge.append(r)
-            logger.info("Yielding batch of %s", len(merge))
-            yield resolve_merge(merge, callermap)
-
+                    groups[key] = [r]
+            # in the order of the records, trimming can move an allele past the next one
+            for key, group in sorted(groups.items(), key = lambda x: (x[1][0].key, x[0])):
+                logger.debug("Yielding %s with %s records", key, len(group))
+                yield resolve_merge(group, callermap)
 
-def main(args):
-    reader = MultiVCFReader(args.INFILES, args.output, args.keys)
-    reader.outwriter.header.add_header('##INFO=<ID=CENTERS,Number=1,Type=String,Description="Center files that made the call">')
-    reader.outwriter.write_header()
-    
-    callermap = dict(zip(args.INFILES, args.keys))
 
+##
+# merges the records of several callers and yields the merged records
+#
+# sources are (caller, header, records) tuples, the records of each sorted
+# by contig (in the order of ranks, see read_contig_ranks) and POS.  Calls
+# from callers with pindel in their name take precedence.  callermap gives
+# the key of each caller listed in CENTERS, the caller itself by default.
+def merge_records(sources, callermap = None, ranks = None, buffer = 10):
+    sources = list(sources)
+    if callermap is None:
+        callermap = {caller: caller for caller, header, records in sources}
+    reader = MultiVCFReader([MetaReader(records, header, caller, ranks) for caller, header, records in sources], buffer)
     for chunk in reader:
         for r, c in resolve_records(chunk, callermap):
             r['INFO'] = {'CENTERS':[c]}
-            reader.outwriter.write_record(r)
+            yield r
+
+##
+# merges the VCF files infiles, called by the callers keys, into output
+#
+# with processes > 1 the inputs are indexed (see hgsc_vcf.index) and each
+# contig is merged into a part file by a pool of that many processes, the
+# parts are put together in the order of the contigs.  Contigs are merged
+# on their own anyway, batches never span two of them, so the output is the
+# same as that of the serial merge.  Inputs that can not be indexed (gzip
+# rather than BGZF) are merged serially.
+def merge_vcfs(infiles, keys, output, ranks = None, processes = None):
+    if processes is not None and processes > 1:
+        try:
+            contigs = _contig_files(infiles, keys, ranks)
+        except ValueError as e:
+            logger.info("Merging serially, %s", e)
+        else:
+            # no more processes than contigs to merge
+            pool = mergesort.make_pool(min(processes, len(contigs)))
+            if pool is not None:
+                _merge_parallel(infiles, contigs, output, ranks, pool)
+                return
+    readers = [hgsc_vcf.Reader(open(f, 'r'), lazy = True) for f in infiles]
+    try:
+        writer = hgsc_vcf.Writer(open(output, 'w'), merge_headers([r.header for r in readers]))
+        writer.write_header()
+        sources = [(f, r.header, r) for f, r in zip(infiles, readers)]
+        writer.write_records(merge_records(sources, dict(zip(infiles, keys)), ranks))
+        writer.close()
+    finally:
+        for r in readers:
+            r.fobj.close()
+
+##
+# [(contig, infiles, keys)] for the contigs of the indexed infiles in rank order
+#
+# a file only takes part up to its first GL contig, like in the serial merge.
+def _contig_files(infiles, keys, ranks):
+    contigs = {}
+    for f, k in zip(infiles, keys):
+        index = hgsc_vcf.index.load_index(f)
+        for c in index.order:
+            if 'GL' in c:
+                break
+            files = contigs.setdefault(c, ([], []))
+            files[0].append(f)
+            files[1].append(k)
+    return [(c, contigs[c][0], contigs[c][1]) for c in sorted(contigs, key = lambda c: contig_rank(c, ranks))]
+
+def _merge_parallel(infiles, contigs, output, ranks, pool):
+    tmpdir = tempfile.mkdtemp('.vcf-merge', dir = os.path.dirname(os.path.abspath(output)))
+    readers = [hgsc_vcf.Reader(open(f, 'r'), lazy = True) for f in infiles]
+    try:
+        writer = hgsc_vcf.Writer(open(output, 'w'), merge_headers([r.header for r in readers]))
+        writer.write_header()
+        results = []
+        for n, (contig, files, keys) in enumerate(contigs):
+            opath = os.path.join(tmpdir, '%d.part.vcf' % n)
+            results.append(pool.apply_async(mergesort.pool_call, (_merge_contig, files, keys, contig, ranks, opath)))
+        pool.close()
+        for result in results:
+            opath, offset = result.get()
+            writer.flush()
+            with open(opath, 'rb') as fi:
+                fi.seek(offset)
+                shutil.copyfileobj(fi, writer.fobj, 1 << 20)
+            os.remove(opath)
+        writer.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for r in readers:
+            r.fobj.close()
+        shutil.rmtree(tmpdir, True)
+
+##
+# merges one contig of the indexed infiles into the VCF opath
+#
+# runs in the pool processes, returns opath and the size of its header,
+# which is left out when the parts are put together.  The records of each
+# caller stream from Reader.fetch, only the merge batches are held.
+def _merge_contig(infiles, keys, contig, ranks, opath):
+    readers = [hgsc_vcf.Reader(open(f, 'r'), lazy = True) for f in infiles]
+    fetches = []
+    try:
+        writer = hgsc_vcf.Writer(open(opath, 'w'), merge_headers([r.header for r in readers]))
+        writer.write_header()
+        writer.flush()
+        offset = writer.fobj.tell()
+        fetches = [r.fetch(contig) for r in readers]
+        sources = [(f, r.header, records) for f, r, records in zip(infiles, readers, fetches)]
+        writer.write_records(merge_records(sources, dict(zip(infiles, keys)), ranks))
+        writer.close()
+    finally:
+        for records in fetches:
+            records.close() # a caller that stops at a GL contig leaves its fetch open
+        for r in readers:
+            r.fobj.close()
+    return opath, offset
+
+def main(args):
+    ranks = read_contig_ranks(args.seqdict) if args.seqdict else None
+    merge_vcfs(args.INFILES, args.keys, args.output, ranks, args.processes)
     logger.info("Done")
             
 
+TEST_HEADER = '''##fileformat=VCFv4.1
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="depth">
+##FORMAT=<ID=AD,Number=.,Type=Integer,Description="depth">
+##SAMPLE=<ID=NORMAL,SampleTCGABarcode=N>
+##SAMPLE=<ID=PRIMARY,SampleTCGABarcode=T>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNORMAL\tPRIMARY
+'''
+
+##
+# writes a test VCF of calls (CHROM, POS, REF, ALT) to tmpdir/name
+def _test_vcf(tmpdir, name, calls):
+    fpath = os.path.join(tmpdir, name)
+    with open(fpath, 'w') as fo:
+        fo.write(TEST_HEADER)
+        for chrom, pos, ref, alt in calls:
+            fo.write('\t'.join([chrom, str(pos), '.', ref, alt, '.', 'PASS', '.', 'GT:DP:AD', '0/0:30:30,0', '0/1:40:25,15']) + '\n')
+    return fpath
+
+##
+# [(CHROM, POS, REF, ALT, CENTERS)] of merging the test VCFs callers
+def _test_merge(callers, **kwargs):
+    readers = [hgsc_vcf.Reader(open(f, 'r'), lazy = True) for f in callers.values()]
+    try:
+        sources = [(c, r.header, r) for c, r in zip(callers, readers)]
+        return [(r['CHROM'], r['POS'], r['REF'], ','.join(r['ALT']), r['INFO']['CENTERS'][0])
+                for r in merge_records(sources, **kwargs)]
+    finally:
+        for r in readers:
+            r.fobj.close()
+
+def test():
+    print "starting test"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # groups come out in the order of their records even when trimming moves one
+        callers = OrderedDict([
+            ('A', _test_vcf(tmpdir, 'a.vcf', [('1', 100, 'CAT', 'CTT'), ('1', 200, 'C', 'T')])),
+            ('B', _test_vcf(tmpdir, 'b.vcf', [('1', 101, 'A', 'G'), ('1', 200, 'C', 'G')])),
+            ('C', _test_vcf(tmpdir, 'c.vcf', [('1', 200, 'C', 'T')]))])
+        assert _test_merge(callers) == [
+                ('1', 100, 'CAT', 'CTT', 'A'), ('1', 101, 'A', 'G', 'B'),
+                ('1', 200, 'C', 'G', 'B'), ('1', 200, 'C', 'T', 'A|C')]
+
+        # a long deletion takes in the calls within it, clusters are cut
+        # at max_cluster records but only between two positions
+        fpath = _test_vcf(tmpdir, 'd.vcf', [('1', 100, 'C' * 50, 'C'), ('1', 140, 'C', 'T'), ('1', 170, 'C', 'T')] +
+                [('1', 1000 + i // 2, 'C', 'GT'[i % 2]) for i in xrange(10)])
+        reader = hgsc_vcf.Reader(open(fpath, 'r'), lazy = True)
+        multi = MultiVCFReader([MetaReader(reader, reader.header, 'D')], max_cluster = 3)
+        batches = [[r.record['POS'] for r in batch] for batch in multi]
+        reader.fobj.close()
+        assert batches == [[100, 140], [170], [1000, 1000, 1001, 1001], [1002, 1002, 1003, 1003], [1004, 1004]]
+        assert (multi.stats['clusters'], multi.stats['cut'], multi.stats['largest'], multi.stats['records']) == (5, 2, 4, 13)
+        # merging the contigs in parallel gives the serial output
+        calls = [(chrom, pos * 7 + i, 'C', 'T') for chrom in ('1', '2', 'X', 'MT') for pos in xrange(1, 2000) for i in (0, 3)]
+        infiles = [_test_vcf(tmpdir, 'p%d.vcf' % n, calls[n::3]) for n in xrange(3)]
+        outputs = []
+        for processes in (None, 3):
+            output = os.path.join(tmpdir, 'merged.%s.vcf' % processes)
+            merge_vcfs(infiles, ['A', 'B', 'C'], output, processes = processes)
+            with open(output, 'r') as fi:
+                outputs.append(fi.read())
+        assert outputs[0] == outputs[1]
+        assert len([l for l in outputs[0].splitlines() if l[0] != '#']) == len(calls)
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
+
 if __name__ == '__main__':
     import argparse
 
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--keys', type = str, help = 'caller keys', nargs = '+')
     parser.add_argument('--output', type = str, help = 'output file')
+    parser.add_argument('--seqdict', type = str, help = 'sequence dict giving the contig order, defaults to 1-22, X, Y, MT')
+    parser.add_argument('--processes', type = int, help = 'merge the contigs in a pool of this many processes')
     parser.add_argument('INFILES', nargs='+', type = str, help = 'input files')
 
     args = parser.parse_args()
@@ -3,14 +3,20 @@ import os, os.path, sys
 import logging
 import hgsc_vcf
 import tempfile, shutil
+import itertools, heapq
+
+# merge.py loads this file to sort in process, the handler is only set up when run as a script
+logger = logging.getLogger('vcf-sort')
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.NullHandler())
+
+# files whose lines fit in this many bytes are sorted in memory
+MAXBYTES = 1 << 30
+# lines held back to repair a file that is nearly sorted
+WINDOW = 10000
+# per line memory on top of the line itself, the string object, key and list slot
+LINE_OVERHEAD = 128
 
-logger = logging.getLogger()                                                               
-logger.setLevel(logging.DEBUG)                                                             
-ch = logging.StreamHandler()                                                               
-ch.setLevel(logging.DEBUG)                                                                 
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')      
-ch.setFormatter(formatter)                                                                 
-logger.addHandler(ch)                                                                      
 class SeqDict(object):
     def __init__(self, f):
         self.f = f
@@ -26,58 +32,104 @@ class SeqDict(object):
             result.append(s[1].split(':',2)[1])
         return result
 
+    ##
+    # {contig: position in the dict}
+    def ranks(self):
+        return {c: i for i, c in enumerate(self.contigs())}
+
+##
+# reads data lines from the iterator lines until they take more than maxbytes
+#
+# returns the lines read and whether that was all of them, the rest can
+# still be read from lines.
+def read_lines(lines, maxbytes):
+    size = 0
+    read = []
+    for line in lines:
+        if not line.strip():
+            continue
+        read.append(line)
+        size += len(line) + LINE_OVERHEAD
+        if size > maxbytes:
+            return read, False
+    return read, True
+
+##
+# the line as hgsc_vcf.Writer writes it, columns stripped and without
+# FORMAT and sample columns when the header has no samples
+def format_line(line, nsamples):
+    cols = line.rstrip('\r\n').split('\t')
+    if not nsamples:
+        cols = cols[:8]
+    return '\t'.join([c.strip() for c in cols]) + '\n'
+
+##
+# sorts raw VCF lines by (contig rank, POS), dropping contigs that are not ranked
+def sort_lines(lines, ranks):
+    keyed = []
+    for line in lines:
+        cols = line.split('\t', 2)
+        rank = ranks.get(cols[0].strip())
+        if rank is None:
+            continue
+        keyed.append((rank, int(cols[1]), line))
+    keyed.sort(key = lambda x: (x[0], x[1]))
+    return [x[2] for x in keyed]
+
+##
+# splits VCF lines into sorted per contig files
+#
+# lines are buffered per contig with the size of each buffer and of all of
+# them kept as they are added.  When the buffers take more than maxbytes the
+# largest one is sorted by POS and spilled to a file of raw lines (no
+# header), formatted the way hgsc_vcf.Writer writes them.
 class FileSplitter(object):
-    def __init__(self, reader, seqdict, nrecs = 10000):
-        self.reader = reader
+    def __init__(self, lines, seqdict, nsamples, maxbytes = MAXBYTES):
+        self.lines = lines
         self.seqdict = seqdict
-        self.nrecs = nrecs
+        self.nsamples = nsamples
+        self.maxbytes = maxbytes
         self._fileindex = 0
         self.tmpdir = tempfile.mkdtemp()
-    
-    def _initialize(self, chrom):
+
+    def _spill(self, chrom, lines):
         self._fileindex += 1
-        writer = hgsc_vcf.Writer(open(os.path.join(self.tmpdir, '%s.%s.split.vcf' % (chrom, str(self._fileindex))), 'w'), self.reader.header)
-        writer.write_header()
-        return writer
+        fpath = os.path.join(self.tmpdir, '%s.%s.split.vcf' % (chrom, str(self._fileindex)))
+        lines.sort(key = lambda x: x[0])
+        with open(fpath, 'w') as fo:
+            fo.writelines([format_line(line, self.nsamples) for pos, line in lines])
+        return fpath
 
     def split(self):
-        # start to split out the input file
         # output pattern is chr.splitnumber.split.vcf
-        # all output files have the input header
-
-        # initialize all 
-        outfiles = {c:[] for c in self.seqdict.contigs()}
-        outcontainer = {c:self._initialize(c) for c in self.seqdict.contigs()}
-        outlines = {c:[] for c in self.seqdict.contigs()}
-        for record in self.reader:
-            c = record['CHROM']
-            if c not in outcontainer:
+        ranks = self.seqdict.ranks()
+        outfiles = {c:[] for c in ranks}
+        outlines = {}
+        outsizes = {}
+        total = 0
+        for line in self.lines:
+            cols = line.split('\t', 2)
+            c = cols[0].strip()
+            if c not in ranks:
                 continue
-            outlines[c].append(record)
-                
-            if sum([len(v) for v in outlines.values()]) > self.nrecs:
-                cc, recs = sorted(outlines.items(), key = lambda x: len(x[1]))[-1]
-                logger.info("Max recs reached, dumping %s", cc)
-                outfiles[cc].append(outcontainer[cc].fobj.name)
-                for rec in sorted(recs, key = lambda x: int(x['POS'])):
-                    try:
-                        outcontainer[cc].write_record(rec)
-                    except:
-                        logger.error("Failed to write line %s", rec)
-                outcontainer[cc].fobj.close()
-                outcontainer[cc] = self._initialize(cc)
-                outlines[cc] = []
-        for c, recs in outlines.items():
-            writer = outcontainer[c]
-            outfiles[c].append(writer.fobj.name)
-            for rec in sorted(recs, key = lambda x: int(x['POS'])):
-                try:
-                    writer.write_record(rec)
-                except:
-                    logger.error("Failed to write line %s", rec)
-            writer.fobj.close()
+            if c not in outlines:
+                outlines[c] = []
+                outsizes[c] = 0
+            outlines[c].append((int(cols[1]), line))
+            size = len(line) + LINE_OVERHEAD
+            outsizes[c] += size
+            total += size
+            if total > self.maxbytes:
+                cc = max(outsizes, key = outsizes.get)
+                logger.info("Max bytes reached, dumping %s", cc)
+                outfiles[cc].append(self._spill(cc, outlines.pop(cc)))
+                total -= outsizes.pop(cc)
+        for c, lines in outlines.items():
+            outfiles[c].append(self._spill(c, lines))
         return outfiles
 
+##
+# merges the split files of each contig in seqdict order into writer
 class FileMerger(object):
     def __init__(self, writer, splitfiles, seqdict):
         self.writer = writer
@@ -86,61 +138,254 @@ class FileMerger(object):
 
     def merge(self):
         for c in self.seqdict.contigs():
-            logger.info("Merging %s", c)
             mergefiles = self.splitfiles[c]
+            if not mergefiles:
+                continue
+            logger.info("Merging %s", c)
             self._merge_contig(mergefiles)
             # merge is complete, remove the files
             for f in mergefiles:
                 os.remove(f)
 
-    def position_compare(self, x, y):
-        return int(x.peek()['POS']) - int(y.peek()['POS'])
+    ##
+    # (POS, file number, line number, line) for the lines of a split file,
+    # the numbers keep equal positions in input order
+    @staticmethod
+    def _keyed(fi, i):
+        for n, line in enumerate(fi):
+            yield int(line.split('\t', 2)[1]), i, n, line
 
     def _merge_contig(self, mergefiles):
-        holder = [hgsc_vcf.Reader(open(f, 'r')) for f in mergefiles]
-        for r in holder:
-            if r.peek() is None:
-                r.take() # will iterate if it can
-        while len(holder) > 1:
-            logger.info("Sorting")
-            holder = sorted([r for r in holder if r.peek() is not None], cmp=self.position_compare)
-            if len(holder) < 2:
-                break
-            h0 = holder[0]
-            h1 = holder[1]
-            while h0.peek() is not None and self.position_compare(h0, h1) < 1:
-                self.writer.write_record(h0.take())
-        last_r = holder[0]
-        while last_r.peek() is not None:
-            self.writer.write_record(last_r.take())
+        handles = [open(f, 'r') for f in mergefiles]
+        try:
+            keyed = [self._keyed(fi, i) for i, fi in enumerate(handles)]
+            for pos, i, n, line in heapq.merge(*keyed):
+                self.writer.write_line(line)
+        finally:
+            for fi in handles:
+                fi.close()
 
-def main(args):
-    # get the seqdict
-    seqdict = SeqDict(args.seqdict)
-
-    # split the file
-    splitter = FileSplitter(hgsc_vcf.Reader(open(args.input, 'r')), seqdict)
-    splitfiles = splitter.split()
-    splitter.reader.fobj.close()
-
-    # write the new files
-    merger = FileMerger(hgsc_vcf.Writer(open(args.output, 'w'), splitter.reader.header), splitfiles, seqdict)
-    merger.writer.write_header()
-    merger.merge()
-    merger.writer.fobj.close()
-    
-    shutil.rmtree(splitter.tmpdir)
+##
+# yields the lines of a list, dropping them from the list as it goes
+def drain(lines):
+    lines.reverse()
+    while lines:
+        yield lines.pop()
+
+##
+# checks how far the VCF at path is from being sorted by ranks and POS
+#
+# returns 'sorted', 'nearly' when holding back window lines in a heap is
+# enough to sort it, or 'unsorted'.  A file with contigs that are not
+# ranked is 'unsorted' since sorting drops those records.  The check stops
+# as soon as the answer is 'unsorted'.
+def sortedness(path, ranks, window = WINDOW):
+    fobj = hgsc_vcf.open_vcf(path)
+    try:
+        in_order = True
+        last = None
+        held = []
+        released = None
+        for line in fobj:
+            if line[0] == '#' or not line.strip():
+                continue
+            cols = line.split('\t', 2)
+            rank = ranks.get(cols[0].strip())
+            if rank is None:
+                return 'unsorted'
+            key = (rank, int(cols[1]))
+            if last is not None and key < last:
+                in_order = False
+            last = key
+            # the keys a bounded heap would let out, these have to come out in order
+            heapq.heappush(held, key)
+            if len(held) > window:
+                key = heapq.heappop(held)
+                if released is not None and key < released:
+                    return 'unsorted'
+                released = key
+        return 'sorted' if in_order else 'nearly'
+    finally:
+        fobj.close()
 
+##
+# copies a sorted input to output, (de)compressing it when the formats differ
+#
+# always a copy, never a link: the input may be a caller's original file
+# and the output may be written to later.
+def copy_sorted(input, output):
+    with open(input, 'rb') as fi:
+        kind = hgsc_vcf.bgzf.sniff(fi.read(16))
+    out_bgzf = output.endswith(hgsc_vcf.io.BGZF_EXTENSIONS)
+    if (kind == 'bgzf') == out_bgzf and kind != 'gzip':
+        shutil.copyfile(input, output)
+        return
+    fi = hgsc_vcf.open_vcf(input)
+    fo = hgsc_vcf.open_vcf(output, 'w')
+    try:
+        shutil.copyfileobj(fi, fo, 1 << 20)
+    finally:
+        fi.close()
+        fo.close()
+
+##
+# sorts a nearly sorted VCF by passing its lines through a heap of window lines
+def repair_vcf(reader, seqdict, output, window = WINDOW):
+    ranks = seqdict.ranks()
+    nsamples = len(reader.header.samples)
+    writer = hgsc_vcf.Writer(open(output, 'w'), reader.header, buffer_size = hgsc_vcf.WRITE_BUFFER)
+    writer.write_header()
+    held = []
+    for n, line in enumerate(iter(reader.fobj.readline, '')):
+        if not line.strip():
+            continue
+        cols = line.split('\t', 2)
+        # (rank, POS, line number) keeps equal positions in input order
+        heapq.heappush(held, (ranks[cols[0].strip()], int(cols[1]), n, line))
+        if len(held) > window:
+            writer.write_line(format_line(heapq.heappop(held)[3], nsamples))
+    while held:
+        writer.write_line(format_line(heapq.heappop(held)[3], nsamples))
+    writer.close()
+
+##
+# sorts the VCF at input into output by the contig order of seqdict
+#
+# a file that is already sorted is copied, one that is nearly
+# sorted is repaired in a single pass with a bounded buffer.  Anything else
+# is sorted in memory when it fits in maxbytes, or split to disk and merged.
+def sort_vcf(seqdict, input, output, maxbytes = MAXBYTES, window = WINDOW):
+    order = sortedness(input, seqdict.ranks(), window)
+    if order == 'sorted':
+        logger.info("%s is sorted already", input)
+        copy_sorted(input, output)
+        return
+
+    reader = hgsc_vcf.Reader(open(input, 'r'), lazy = True)
+    if order == 'nearly':
+        logger.info("Repairing the order of %s", input)
+        repair_vcf(reader, seqdict, output, window)
+        reader.fobj.close()
+        return
+
+    logger.info("Sorting %s", input)
+    writer = hgsc_vcf.Writer(open(output, 'w'), reader.header, buffer_size = hgsc_vcf.WRITE_BUFFER)
+    writer.write_header()
+    # readline so that the reader can carry on where the header ended
+    write_sorted(writer, iter(reader.fobj.readline, ''), seqdict, maxbytes)
+    writer.close()
+    reader.fobj.close()
+
+##
+# sorts the records of a stream (the output of a filter for one) into output
+#
+# the records are formatted for header as they come in and sorted like the
+# lines of a file, without writing them out first.
+def sort_records(seqdict, header, records, output, maxbytes = MAXBYTES):
+    writer = hgsc_vcf.Writer(open(output, 'w'), header, buffer_size = hgsc_vcf.WRITE_BUFFER)
+    writer.write_header()
+    write_sorted(writer, (writer.format_record(r) for r in records), seqdict, maxbytes)
+    writer.close()
+
+##
+# writes the VCF lines of the iterator lines sorted to writer, after its header
+#
+# the lines are sorted in memory when they fit in maxbytes, or split to
+# disk and merged.
+def write_sorted(writer, lines, seqdict, maxbytes = MAXBYTES):
+    nsamples = len(writer.header.samples)
+    first, complete = read_lines(lines, maxbytes)
+    if complete:
+        # fits in memory, sort the lines as they are
+        logger.info("Sorting %s lines in memory", len(first))
+        for line in sort_lines(first, seqdict.ranks()):
+            writer.write_line(format_line(line, nsamples))
+        return
+
+    # split the lines, starting with the ones that were already read
+    logger.info("Splitting lines to disk")
+    splitter = FileSplitter(itertools.chain(drain(first), lines), seqdict, nsamples, maxbytes)
+    first = None
+    try:
+        FileMerger(writer, splitter.split(), seqdict).merge()
+    finally:
+        shutil.rmtree(splitter.tmpdir)
+
+TEST_HEADER = '''##fileformat=VCFv4.1
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+'''
+
+def _test_vcf(path, lines):
+    with open(path, 'w') as fo:
+        fo.write(TEST_HEADER)
+        fo.writelines(lines)
+    return path
+
+def _test_body(path):
+    with open(path, 'r') as fi:
+        return [l for l in fi if l[0] != '#']
+
+def test():
+    print "starting test"
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sdpath = os.path.join(tmpdir, 'ref.dict')
+        with open(sdpath, 'w') as fo:
+            for c in ('2', '1', 'X'): # not in lexical order
+                fo.write('@SQ\tSN:%s\tLN:100000\n' % c)
+        seqdict = SeqDict(sdpath)
+        ranks = seqdict.ranks()
+        expected = ['%s\t%d\t.\tA\tT\t.\tPASS\t.\n' % (c, p) for c in ('2', '1', 'X') for p in xrange(1, 3000, 3)]
+        nearly = list(expected)
+        for i in xrange(0, len(nearly) - 1, 50):
+            nearly[i], nearly[i + 1] = nearly[i + 1], nearly[i]
+        cases = [
+                ('sorted', expected, 'sorted'),
+                ('nearly', nearly, 'nearly'),
+                ('reversed', list(reversed(expected)), 'unsorted'),
+                ('unranked', expected + ['GL000192.1\t5\t.\tA\tT\t.\tPASS\t.\n'], 'unsorted')]
+        for name, lines, order in cases:
+            input = _test_vcf(os.path.join(tmpdir, name + '.vcf'), lines)
+            assert sortedness(input, ranks, 10) == order, name
+            for maxbytes in (MAXBYTES, 1 << 14): # in memory and split to disk
+                output = os.path.join(tmpdir, name + '.sorted.vcf')
+                sort_vcf(seqdict, input, output, maxbytes, 10)
+                assert _test_body(output) == expected, (name, maxbytes)
+                # a sorted input is copied, not linked
+                assert os.stat(output).st_ino != os.stat(input).st_ino
+        # a nearly sorted file that needs a larger window than it has is sorted anyway
+        input = _test_vcf(os.path.join(tmpdir, 'far.vcf'), expected[100:] + expected[:100])
+        assert sortedness(input, ranks, 10) == 'unsorted'
+        # records streamed in from a filter
+        output = os.path.join(tmpdir, 'records.vcf')
+        reader = hgsc_vcf.Reader(open(input, 'r'))
+        sort_records(seqdict, reader.header, reader, output, 1 << 14)
+        reader.fobj.close()
+        assert _test_body(output) == expected
+    finally:
+        shutil.rmtree(tmpdir)
+    print "Success"
+
+def main(args):
+    sort_vcf(SeqDict(args.seqdict), args.input, args.output, args.maxbytes, args.window)
     logger.info("Done")
 
 if __name__ == '__main__':
     import argparse
 
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
     parser = argparse.ArgumentParser()
     
     parser.add_argument('seqdict', type = str, help = 'sequence dict file')
     parser.add_argument('input', type = str, help = 'input file')
     parser.add_argument('output', type = str, help = 'output file')
+    parser.add_argument('--maxbytes', type = int, default = MAXBYTES, help = 'memory for sorting in memory, larger files are split to disk')
+    parser.add_argument('--window', type = int, default = WINDOW, help = 'lines to hold back when repairing a nearly sorted file')
 
     args = parser.parse_args()
 